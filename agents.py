@@ -1,6 +1,8 @@
+import bisect
+import heapq
 import math
-import random
 from mesa import Agent
+from events import DROP, COLLECT, RETURN, BUY, VERBOSE
 
 
 class Stand(Agent):
@@ -23,39 +25,60 @@ class Stand(Agent):
 
     def sell_drink(self, visitor):
         #if visitor.cup is not None:
+        log = self.model.log
         for cup in visitor.collected_cups:
 
-            print('Cup gets returned')
-            self.model.schedule.remove(cup)  # Return current cup
+            if log.active[RETURN]:
+                log.record(RETURN, self.model.schedule.time, visitor.number, self.pos)
+            self.model.cups.remove(cup)  # Return current cup
+            self.model.cup_count -= 1
             self.model.cups_returned += 1
-            print(self.model.cups_returned)
 
-        a = Cup(self.model)
-        self.model.schedule.add(a)
+        a = self.model.cups.create()
+        self.model.cup_count += 1
         Visitor.cup = a
         Visitor.condition = "HasCup"
-        print('Selling cup')
+        if log.active[BUY]:
+            log.record(BUY, self.model.schedule.time, visitor.number, self.pos)
 
 
-class Cup(Agent):
+class Cup:
     '''
     Is created as full by Stand, moves with Visitor until it is either returned or dropped.
     Can also be collected and damaged.
+
+    Cups are not part of the schedule but live in the CupPool of the model. Dirt is counted in tenths and
+    only builds up on the floor: every step on the floor a cup gets 0.1 dirtier with odds 1/5, up to 1.0.
+    Rather than drawing this every step, the steps at which the cup gets dirtier are drawn when it is dropped,
+    and dirty is computed from them when it is queried.
     '''
 
+    __slots__ = ('unique_id', 'model', 'pos', 'full', 'damaged', 'on_floor', 'reuse_count', 'condition',
+                 'dirt', 'dropped_at', 'soil_times')
+
     def __init__(self, model):
 
         model.cup_id += 1
 
-        id = model.cup_id
-
-        super().__init__(id, model)
+        self.unique_id = model.cup_id
+        self.model = model
+        self.pos = None
         self.full = 200 #given out with 200 ml of content
-        self.dirty = 0.0
         self.damaged = 0.0
         self.on_floor = False
         self.reuse_count = 0
         self.condition = ""
+        self.dirt = 0 # tenths of dirt gathered before the cup was last dropped
+        self.dropped_at = None
+        self.soil_times = () # steps at which the cup gets 0.1 dirtier while on the floor
+
+    @property
+    def dirty(self):
+        '''
+        Dirt on the cup, between 0.0 and 1.0
+        '''
+
+        return (self.dirt + bisect.bisect_right(self.soil_times, self.model.schedule.time)) / 10
 
     def fill(self):
         ''''
@@ -64,11 +87,76 @@ class Cup(Agent):
 
         self.full = 200
 
+    def drop(self):
+        '''
+        Put the cup on the floor and draw the steps at which it gets dirtier. The gaps between them are
+        geometric with p = 1/5, the same as an independent 1/5 chance every step.
+        '''
+
+        self.on_floor = True
+        self.dropped_at = self.model.schedule.time
+        soil_times = []
+        time = self.dropped_at
+        for i in range(10 - self.dirt):
+            time += int(math.log(1.0 - self.model.rng_dirt.random()) / math.log(0.8)) + 1
+            soil_times.append(time)
+        self.soil_times = tuple(soil_times)
+        self.model.cups.dropped(self)
+
+    def pick_up(self):
+        '''
+        Take the cup off the floor, it keeps the dirt it has gathered
+        '''
+
+        self.dirt = round(self.dirty * 10)
+        self.on_floor = False
+        self.soil_times = ()
+
+
+class CupPool:
+    '''
+    All Cups in the model, kept out of the schedule since they have nothing to do while carried or returned.
+    Tells the grid when a cup on the floor becomes too dirty to be collected.
+    '''
+
+    def __init__(self, model):
+        self.model = model
+        self.cups = {} # unique_id -> Cup, in order of creation
+        self.soiling = [] # heap of (step, unique_id, drop step) at which a cup on the floor reaches 0.7 dirt
+
+    def __len__(self):
+        return len(self.cups)
+
+    def __iter__(self):
+        return iter(self.cups.values())
+
+    def create(self):
+        '''Create a new Cup'''
+
+        cup = Cup(self.model)
+        self.cups[cup.unique_id] = cup
+        return cup
+
+    def remove(self, cup):
+        '''Remove a Cup from the model'''
+
+        del self.cups[cup.unique_id]
+
+    def dropped(self, cup):
+        '''Register a Cup that was just dropped'''
+
+        if cup.dirt < 7:
+            heapq.heappush(self.soiling, (cup.soil_times[6 - cup.dirt], cup.unique_id, cup.dropped_at))
+
     def step(self):
-        if self.on_floor == True:
-            if random.randint(1,5) == 1 and self.dirty < 1:
-                self.dirty += 0.1
+        '''Update the grid for the cups on the floor that have become too dirty to be collected'''
 
+        time = self.model.schedule.time
+        while self.soiling and self.soiling[0][0] <= time:
+            _, unique_id, dropped_at = heapq.heappop(self.soiling)
+            cup = self.cups.get(unique_id)
+            if cup is not None and cup.on_floor and cup.dropped_at == dropped_at:
+                self.model.grid.soil_cup(cup)
 
 
 class Visitor(Agent):
@@ -82,9 +170,11 @@ class Visitor(Agent):
     y = None
     moore = True
 
-    def __init__(self, unique_id, model, reluctance, thirst_rate, sip_size):
+    def __init__(self, unique_id, model, reluctance, thirst_rate, sip_size, number=0):
 
         super().__init__(unique_id, model)
+        self.number = number # numeric id, used in the event log
+        self.traced = unique_id == "v1" and model.log.level >= VERBOSE # report everything this visitor does
         self.thirst = 20 # initial thirst is 20%
         self.cup = None
         self.collected_cups = []
@@ -94,7 +184,7 @@ class Visitor(Agent):
         self.thirst_rate = thirst_rate
         self.sip_size = sip_size
 
-        if self.unique_id == "v1" and self.model.verbose:
+        if self.traced:
             print(self.unique_id, "I have a reluctance of", self.reluctance, ", a thirst rate of", self.thirst_rate, "% and a sip size of", self.sip_size, "ml")
 
     def random_move(self):
@@ -104,10 +194,10 @@ class Visitor(Agent):
 
         # Pick the next cell from the adjacent cells.
         next_moves = self.model.grid.get_neighborhood(self.pos, self.moore, True)
-        next_move = self.random.choice(next_moves)
+        next_move = self.model.rng_move.choice(next_moves)
         # Now move:
         self.model.grid.move_agent(self, next_move)
-        if self.unique_id == "v1" and self.model.verbose:
+        if self.traced:
             if self.cup is not None:
                 report_contents = "and my cup contains " + str(self.cup.full) + " / 200 ml"
             else:
@@ -116,24 +206,25 @@ class Visitor(Agent):
 
     def move_towards(self, pos):
         '''
-        Move towards specific coordinate
+        Move towards specific coordinate, along the shortest way around the torus
         '''
 
         # Find new position after moving towards pos
         new = [0, 0]
-        for i in [0, 1]:
-            if self.pos[i] > pos[i]:
-                new[i] = self.pos[i] - 1
-            elif self.pos[i] < pos[i]:
+        for i, size in enumerate((self.model.grid.width, self.model.grid.height)):
+            distance = (pos[i] - self.pos[i]) % size
+            if distance == 0:
+                new[i] = self.pos[i]
+            elif distance <= size / 2:
                 new[i] = self.pos[i] + 1
             else:
-                new[i] = self.pos[i]
+                new[i] = self.pos[i] - 1
 
         # Now move
-        if self.unique_id == "v1" and self.model.verbose:
+        if self.traced:
             print(self.unique_id, 'current position is ' + str(self.pos), "my thirst is", self.thirst, "%")
         self.model.grid.move_agent(self, tuple(new))
-        if self.unique_id == "v1" and self.model.verbose:
+        if self.traced:
             print(self.unique_id,'new position is ' + str(self.pos))
 
     def find_stand(self):
@@ -141,10 +232,7 @@ class Visitor(Agent):
         Find the nearest Stand and return the nearest
         '''
 
-        options = [a for a in self.model.schedule.agents if isinstance(a, Stand)]
-        nearest = min(options, key=lambda x: math.dist(x.pos, self.pos))
-
-        return nearest
+        return self.model.nearest_stand(self.pos)
 
     def drop_cup(self):
         '''
@@ -152,26 +240,22 @@ class Visitor(Agent):
         '''
 
         # compute odds that Visitor drops cup depending on surrounding trash
-        trash = 0
-        for neighbor in self.model.grid.neighbor_iter(self.pos):
-            if isinstance(neighbor, Cup):
-                if neighbor.on_floor == True:
-                    trash += 1
+        trash = self.model.grid.trash_around(self.pos)
 
         odds = min(0.1 + trash/5, 1)
 
         # drop cup
-        if random.random() < odds:
-            self.cup.on_floor = True
+        if self.model.rng_decide.random() < odds:
+            self.cup.drop()
             self.model.cups_on_floor += 1
-            print("t =", str(self.model.schedule.time), ", 1 cup dropped (", self.model.cups_on_floor, ")")
-            self.cup.pos = self.pos
+            if self.model.log.active[DROP]:
+                self.model.log.record(DROP, self.model.schedule.time, self.number, self.pos)
             self.condition = "HasNoCup"
-            self.model.grid.place_agent(self.cup,self.cup.pos) # place the Cup agent in the grid
+            self.model.grid.drop_cup(self.cup, self.pos) # place the Cup agent in the grid
             self.cup = None
 
             # log if verbose
-            if self.unique_id == "v1" and self.model.verbose:
+            if self.traced:
                 print(self.unique_id, 'DROPPING CUP!')
                 print(self.model.cups_on_floor)
 
@@ -179,25 +263,26 @@ class Visitor(Agent):
         '''If trash is around, possibly collect a cup. Odds are based on the model attribute awareness'''
 
         # Assess whether trash is around
-        possible = False
-        for neighbor in self.model.grid.neighbor_iter(self.pos):
-            if isinstance(neighbor, Cup):
-                if neighbor.on_floor == True and neighbor.dirty < 0.7:
-                    possible = True
-                    cup_to_pick = neighbor
+        possible = self.model.grid.clean_around(self.pos) > 0
 
         # Possible
         if possible:
-            if random.random() < self.model.awareness:
+            if self.model.rng_decide.random() < self.model.awareness:
+                for neighbor in self.model.grid.neighbor_iter(self.pos):
+                    if isinstance(neighbor, Cup):
+                        if neighbor.on_floor == True and neighbor.dirty < 0.7:
+                            cup_to_pick = neighbor
+
                 self.collected_cups.append(cup_to_pick)
-                cup_to_pick.on_floor = False
                 self.model.cups_on_floor -= 1
-                print("t =", str(self.model.schedule.time),", 1 cup collected (", self.model.cups_on_floor, ")")
+                if self.model.log.active[COLLECT]:
+                    self.model.log.record(COLLECT, self.model.schedule.time, self.number, cup_to_pick.pos)
                 self.condition = "HasCup"
-                self.model.grid.remove_agent(cup_to_pick)  #remove the agent from the grid
+                self.model.grid.pick_up_cup(cup_to_pick)  #remove the agent from the grid
+                cup_to_pick.pick_up()
 
                 # log if verbose
-                if self.unique_id == "v1" and self.model.verbose:
+                if self.traced:
                     print(self.unique_id, 'DROPPING CUP!')
                     print(self.model.cups_on_floor)
 
@@ -210,12 +295,14 @@ class Visitor(Agent):
 
         # If Visitor already has a cup, this cup is returned.
         if self.cup is not None:
-            if self.unique_id == "v1" and self.model.verbose:
+            if self.traced:
                 print(self.unique_id,'RETURNING CUP!')
             self.cup.condition = "returned"
             stand.cups.append(self.cup)
             self.model.cups_returned += 1
-            if self.unique_id == "v1" and self.model.verbose:
+            if self.model.log.active[RETURN]:
+                self.model.log.record(RETURN, self.model.schedule.time, self.number, stand.pos)
+            if self.traced:
                 print(stand.unique_id, "Cups that have been returned: ", self.model.cups_returned)
 
         # reuse if used cups in inventory
@@ -223,18 +310,22 @@ class Visitor(Agent):
             recycled_cup = stand.cups[-1] # last returned cup
             recycled_cup.fill() # fill cup
             recycled_cup.reuse_count += 1 # register recycle count
+            self.model.reuse_count += 1
             self.cup = recycled_cup # give cup to agent
             stand.cups.pop() # remove cup from stand
 
         # create new cup agent if no reusables in inventory
         else:
-            a = Cup(self.model)
-            self.model.schedule.add(a)
+            a = self.model.cups.create()
+            self.model.cup_count += 1
             self.cup = a
             self.condition = "HasCup"
 
+        if self.model.log.active[BUY]:
+            self.model.log.record(BUY, self.model.schedule.time, self.number, stand.pos)
+
         # log if verbose
-        if self.unique_id == "v1" and self.model.verbose:
+        if self.traced:
             print(self.unique_id,'I bought a new drink, back to partying')
 
     def get_drink(self):
@@ -248,7 +339,7 @@ class Visitor(Agent):
         if self.pos == goal.pos:
             self.buy_drink(goal)
         else:
-            if self.unique_id == "v1" and self.model.verbose:
+            if self.traced:
                 print(self.unique_id, "Getting a drink")
             self.move_towards(goal.pos)
 
@@ -256,7 +347,7 @@ class Visitor(Agent):
 
         if self.cup is not None and self.cup.full > 0:
                 # Take sip from cup
-                if self.unique_id == "v1" and self.model.verbose:
+                if self.traced:
                     print(self.unique_id, "my thirst is", self.thirst, '%. Drinking...')
                 self.cup.full -= min(self.cup.full,
                                      self.sip_size)  # sip size of 20ml or whatever amount under 20ml is remaining
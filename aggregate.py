@@ -0,0 +1,232 @@
+from statistics import NormalDist
+
+import numpy as np
+
+
+# metrics of a run that are aggregated over the iterations of a scenario
+METRICS = ('Lost cups', 'Total cups', 'Reuse count', 'Lost ratio')
+
+# two-sided critical values of Student's t distribution for 1 to 30 degrees of freedom, per confidence level
+T_TABLE = {
+    0.90: (6.314, 2.920, 2.353, 2.132, 2.015, 1.943, 1.895, 1.860, 1.833, 1.812, 1.796, 1.782, 1.771, 1.761, 1.753,
+           1.746, 1.740, 1.734, 1.729, 1.725, 1.721, 1.717, 1.714, 1.711, 1.708, 1.706, 1.703, 1.701, 1.699, 1.697),
+    0.95: (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131,
+           2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042),
+    0.99: (63.657, 9.925, 5.841, 4.604, 4.032, 3.707, 3.499, 3.355, 3.250, 3.169, 3.106, 3.055, 3.012, 2.977, 2.947,
+           2.921, 2.898, 2.878, 2.861, 2.845, 2.831, 2.819, 2.807, 2.797, 2.787, 2.779, 2.771, 2.763, 2.756, 2.750),
+}
+
+
+def t_quantile(df, confidence=0.95):
+    '''
+    Return the two-sided critical value of Student's t distribution with df degrees of freedom, from T_TABLE,
+    or from the Cornish-Fisher expansion around the normal quantile beyond 30 degrees of freedom or for other
+    confidence levels
+    '''
+
+    if df < 1:
+        return float('inf')
+    if confidence in T_TABLE and df <= 30:
+        return T_TABLE[confidence][df - 1]
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    return (z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3))
+
+
+def lost_ratio(lost, total, reused):
+    '''Return the cups lost per cup used, as in visualize_batch'''
+
+    used = np.asarray(total + reused, dtype=float)
+    return np.divide(lost, used, out=np.zeros_like(used), where=used > 0)
+
+
+class RunningStats:
+    '''Running mean and variance per step over runs, with Welford's algorithm'''
+
+    def __init__(self, steps):
+        self.n = 0
+        self.mean = np.zeros(steps)
+        self.m2 = np.zeros(steps)
+
+    def update(self, values):
+        '''Add the values of one run, one per step'''
+
+        self.n += 1
+        delta = values - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (values - self.mean)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else np.full_like(self.mean, np.nan)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def interval(self, confidence=0.95, student=False):
+        '''
+        Return the lower and upper bound of the confidence interval of the mean per step, normal or, with
+        student, from Student's t distribution, which is wider for few runs
+        '''
+
+        quantile = t_quantile(self.n - 1, confidence) if student else NormalDist().inv_cdf(0.5 + confidence / 2)
+        half = quantile * self.std / np.sqrt(self.n)
+        return self.mean - half, self.mean + half
+
+
+class P2Quantile:
+    '''
+    Running estimate of a quantile per step over runs, with the P-square algorithm of Jain and Chlamtac,
+    which keeps five markers per step instead of all values
+    '''
+
+    def __init__(self, steps, p):
+        self.p = p
+        self.n = 0
+        self.heights = np.zeros((5, steps))
+        self.positions = np.tile(np.arange(1.0, 6.0)[:, None], (1, steps))
+        self.desired = np.tile(np.array([1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5])[:, None], (1, steps))
+        self.increments = np.array([0, p / 2, p, (1 + p) / 2, 1])[:, None]
+
+    def update(self, values):
+        '''Add the values of one run, one per step'''
+
+        self.n += 1
+        if self.n <= 5:
+            self.heights[self.n - 1] = values
+            if self.n == 5:
+                self.heights.sort(axis=0)
+            return
+
+        q, n = self.heights, self.positions
+        steps = np.arange(q.shape[1])
+
+        # find the cell of every value and extend the extreme markers
+        q[0] = np.minimum(q[0], values)
+        q[4] = np.maximum(q[4], values)
+        k = np.clip((values[None, :] >= q[1:4]).sum(axis=0), 0, 3)
+        n[np.arange(5)[:, None] > k[None, :]] += 1
+        self.desired += self.increments
+
+        # adjust the middle markers
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            move = ((d >= 1) & (n[i + 1] - n[i] > 1)) | ((d <= -1) & (n[i - 1] - n[i] < -1))
+            d = np.sign(d) * move
+            parabolic = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+            neighbor = np.where(d > 0, i + 1, i - 1)
+            linear = q[i] + d * (q[neighbor, steps] - q[i]) / (n[neighbor, steps] - n[i])
+            ok = (q[i - 1] < parabolic) & (parabolic < q[i + 1])
+            q[i] = np.where(move, np.where(ok, parabolic, linear), q[i])
+            n[i] += d
+
+    @property
+    def value(self):
+        '''Return the estimated quantile per step'''
+
+        if self.n >= 5:
+            return self.heights[2].copy()
+        return np.quantile(self.heights[:self.n], self.p, axis=0)
+
+
+class ScenarioAggregate:
+    '''
+    Running mean, variance and quantiles per step of the metrics of a scenario, updated as every iteration
+    finishes, so the runs themselves do not have to be kept. Memory is O(steps) per scenario.
+
+    Statistics are kept per recorded step: every step, or for downsampled runs the steps in the index of the
+    first run, which all runs of the scenario must share.
+    '''
+
+    def __init__(self, steps, quantiles=(0.05, 0.5, 0.95)):
+        self.steps = steps
+        self.quantiles = quantiles
+        self.start(np.arange(steps))
+
+    def start(self, index):
+        '''Set up the statistics for runs recorded at the given steps'''
+
+        self.index = np.asarray(index, dtype=np.int64)
+        self.stats = {metric: RunningStats(len(self.index)) for metric in METRICS}
+        self.estimates = {metric: [P2Quantile(len(self.index), p) for p in self.quantiles] for metric in METRICS}
+
+    @property
+    def iterations(self):
+        return self.stats[METRICS[0]].n
+
+    def update(self, data):
+        '''Add one run, a DataFrame of model variables as collected by Festival, indexed by step'''
+
+        if self.iterations == 0 and not np.array_equal(data.index, self.index):
+            self.start(data.index) # downsampled
+        elif not np.array_equal(data.index, self.index):
+            raise ValueError("the runs of a scenario must be recorded at the same steps")
+        values = {metric: data[metric].to_numpy(dtype=float) for metric in METRICS[:3]}
+        values['Lost ratio'] = lost_ratio(values['Lost cups'], values['Total cups'], values['Reuse count'])
+        for metric in METRICS:
+            self.stats[metric].update(values[metric])
+            for estimate in self.estimates[metric]:
+                estimate.update(values[metric])
+
+    def to_frame(self, confidence=0.95):
+        '''Return a DataFrame per step with the mean, standard deviation, confidence interval and quantiles of every metric'''
+
+        import pandas as pd
+
+        columns = {}
+        for metric in METRICS:
+            stats = self.stats[metric]
+            low, high = stats.interval(confidence)
+            columns[(metric, 'mean')] = stats.mean
+            columns[(metric, 'std')] = stats.std
+            columns[(metric, 'low')] = low
+            columns[(metric, 'high')] = high
+            for p, estimate in zip(self.quantiles, self.estimates[metric]):
+                columns[(metric, 'q' + str(p))] = estimate.value
+        return pd.DataFrame(columns, index=pd.Index(self.index, name='Step'))
+
+
+def final_metrics(data):
+    '''Return the metrics of a run at its last step, as an array in the order of METRICS'''
+
+    last = data.iloc[-1]
+    lost, total, reused = (float(last[metric]) for metric in METRICS[:3])
+    return np.array([lost, total, reused, float(lost_ratio(lost, total, reused))])
+
+
+def paired_differences(finals, baseline, confidence=0.95):
+    '''
+    Return a DataFrame with the difference of every scenario with the baseline per metric, estimated from
+    paired iterations: iteration i of every scenario ran with the same random numbers, so the differences
+    per iteration vary less than the scenarios themselves. The variance reduction is the variance of the
+    difference of independent runs divided by that of the paired difference.
+
+    Args:
+        finals: dict of scenario name -> array of final metrics, a row per iteration
+        baseline: name of the scenario the others are compared with
+    '''
+
+    import pandas as pd
+
+    base = finals[baseline]
+    rows = {}
+    for name, values in finals.items():
+        if name == baseline:
+            continue
+        diff = values - base
+        n = len(diff)
+        t = t_quantile(n - 1, confidence) # few iterations, the normal quantile would give too narrow intervals
+        std = diff.std(axis=0, ddof=1)
+        independent = values.var(axis=0, ddof=1) + base.var(axis=0, ddof=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            reduction = independent / std ** 2
+        for i, metric in enumerate(METRICS):
+            mean = diff[:, i].mean()
+            rows[name, metric] = {'scenario': values[:, i].mean(), 'baseline': base[:, i].mean(), 'difference': mean, 'std': std[i],
+                                  'low': mean - t * std[i] / np.sqrt(n), 'high': mean + t * std[i] / np.sqrt(n), 'variance reduction': reduction[i]}
+    frame = pd.DataFrame.from_dict(rows, orient='index')
+    frame.index.names = ['Scenario', 'Metric']
+    return frame
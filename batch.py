@@ -0,0 +1,355 @@
+import os
+from multiprocessing import Pool
+from queue import Queue
+
+import numpy as np
+from tqdm import tqdm
+
+from aggregate import METRICS, RunningStats, ScenarioAggregate, final_metrics, lost_ratio, paired_differences
+from cache import params_digest
+from model import Festival
+from profiling import Profiler
+from store import ResultStore
+
+
+def job_seed(seed, params, iteration, common=False):
+    '''
+    Return the seed of a single (scenario, iteration) job, derived from the seed of the batch and the
+    parameters of the scenario, so it does not change when other scenarios are added or reordered.
+    With common random numbers the seed only depends on the iteration, so matched iterations of
+    different scenarios share their seed.
+    '''
+
+    if common:
+        return int(np.random.SeedSequence([seed, iteration]).generate_state(1)[0])
+    scenario = int(params_digest(params)[:8], 16)
+    return int(np.random.SeedSequence([seed, scenario, iteration]).generate_state(1)[0])
+
+
+def run_job(job):
+    '''Run a single (scenario, iteration) job and return its model variables'''
+
+    scenario, iteration, params, max_steps, seed = job
+    model = Festival(seed=seed, **params)
+    for i in range(max_steps):
+        model.step()
+    model.datacollector.finish() # downsampled runs end with the last step
+
+    data = model.datacollector.get_model_vars_dataframe()
+    model.datacollector.close() # delete the spill file, if any
+    data.index.name = 'Step'
+    data['Iteration'] = iteration
+    return scenario, iteration, data
+
+
+def profile_job(job):
+    '''Run a single (scenario, iteration) job with profiling and return its Profiler'''
+
+    scenario, iteration, params, max_steps, seed, sample = job
+    model = Festival(seed=seed, profile=sample, **params)
+    for i in range(max_steps):
+        model.step()
+    return model.profiler
+
+
+def hotspot_job(job):
+    '''Run a single (scenario, iteration) job with per cell counts and return its CellAccumulators'''
+
+    scenario, iteration, params, max_steps, seed = job
+    model = Festival(seed=seed, hotspots=True, **params)
+    for i in range(max_steps):
+        model.step()
+    return scenario, model.hotspots
+
+
+def run_meta(params, seed, max_steps):
+    '''Return what identifies a run in a ResultStore: a hash of its parameters, its seed and number of steps'''
+
+    return {'params': params_digest(params), 'seed': seed, 'max_steps': max_steps}
+
+
+def stream_job(job):
+    '''Run a single (scenario, iteration) job and stream its model variables to a ResultStore partition'''
+
+    name, iteration, params, max_steps, seed, root = job
+    model = Festival(seed=seed, **params)
+    collector = model.datacollector
+    run = run_meta(params, seed, max_steps)
+    if collector.plain:
+        writer = ResultStore(root).writer(name, iteration, collector.columns, run=run)
+    else: # downsampled, keep the step of every row
+        writer = ResultStore(root).writer(name, iteration, ['Step', *collector.columns], dtype='<f8' if collector.aggregate else '<i8', run=run)
+    def write(): # the row that was just recorded
+        writer.append(collector.last() if collector.plain else [collector.steps - 1, *collector.last()])
+
+    for i in range(max_steps):
+        rows = collector.rows
+        model.step()
+        if collector.rows > rows:
+            write()
+    rows = collector.rows
+    collector.finish() # downsampled runs end with the last step
+    if collector.rows > rows:
+        write()
+    writer.close()
+    collector.close()
+    return name, iteration
+
+
+def run_to_store(parameters_list, iterations, max_steps, store, processes=None, seed=0, display_progress=True):
+    '''
+    Run every scenario a number of iterations like run_scenarios, but stream the model variables of every
+    step to a ResultStore on disk instead of collecting them in memory. Runs that are already complete
+    in the store with the same parameters, seed and steps are skipped, so an interrupted batch can be
+    resumed; runs made with other values are run again.
+
+    Returns:
+        the ResultStore
+    '''
+
+    jobs = []
+    for params in parameters_list:
+        for iteration in range(iterations):
+            run_seed = job_seed(seed, params, iteration)
+            if not store.complete(params['name'], iteration, run_meta(params, run_seed, max_steps)):
+                jobs.append((params['name'], iteration, params, max_steps, run_seed, str(store.root)))
+
+    if jobs:
+        with Pool(processes) as pool:
+            finished = pool.imap_unordered(stream_job, jobs)
+            for name, iteration in tqdm(finished, total=len(jobs), disable=not display_progress):
+                pass
+    return store
+
+
+def iter_runs(parameters_list, iterations, max_steps, processes=None, seed=0, display_progress=True, cache=None, common_random_numbers=False):
+    '''
+    Run every scenario a number of iterations over a pool of worker processes and yield
+    (name, iteration, data) for every run as soon as it is finished. Runs found in the cache are yielded first.
+    With common_random_numbers, iteration i of every scenario runs with the same seed.
+    '''
+
+    names = [params['name'] for params in parameters_list]
+    assert len(set(names)) == len(names), "scenario names must be unique"
+
+    jobs = [(scenario, iteration, params, max_steps, job_seed(seed, params, iteration, common_random_numbers))
+            for scenario, params in enumerate(parameters_list) for iteration in range(iterations)]
+
+    # load finished runs from the cache
+    keys = {}
+    missing = []
+    for job in jobs:
+        scenario, iteration, params, max_steps, run_seed = job
+        if cache is not None:
+            keys[scenario, iteration] = cache.key(params, run_seed, max_steps)
+            data = cache.get(keys[scenario, iteration])
+            if data is not None:
+                data['Iteration'] = iteration
+                yield names[scenario], iteration, data
+                continue
+        missing.append(job)
+
+    if missing:
+        with Pool(processes) as pool:
+            finished = pool.imap_unordered(run_job, missing)
+            for scenario, iteration, data in tqdm(finished, total=len(missing), disable=not display_progress):
+                if cache is not None:
+                    cache.put(keys[scenario, iteration], data)
+                yield names[scenario], iteration, data
+
+
+def run_scenarios(parameters_list, iterations, max_steps, processes=None, seed=0, display_progress=True, on_result=None, cache=None):
+    '''
+    Run every scenario a number of iterations, spread over a pool of worker processes. Replaces the
+    FixedBatchRunner from mesa.
+
+    Args:
+        parameters_list: list of dicts with Festival parameters, each with a unique 'name'
+        iterations: number of runs per scenario
+        max_steps: number of steps per run
+        processes: number of worker processes, defaults to the number of cores
+        seed: seed of the batch, every job gets its own seed derived from it
+        display_progress: show a progress bar
+        on_result: optional function called as on_result(name, iteration, data) as soon as a run finishes
+        cache: optional ResultCache, only runs that are not in the cache are simulated
+
+    Returns:
+        dict of scenario name -> DataFrame with the model variables of all iterations, in order of iteration
+    '''
+
+    import pandas as pd
+
+    results = {}
+    for name, iteration, data in iter_runs(parameters_list, iterations, max_steps, processes, seed, display_progress, cache):
+        results[name, iteration] = data
+        if on_result is not None:
+            on_result(name, iteration, data)
+
+    return {params['name']: pd.concat([results[params['name'], iteration] for iteration in range(iterations)])
+            for params in parameters_list}
+
+
+def run_aggregated(parameters_list, iterations, max_steps, quantiles=(0.05, 0.5, 0.95), processes=None, seed=0, display_progress=True, cache=None):
+    '''
+    Run every scenario a number of iterations like run_scenarios, but only keep running statistics per
+    scenario and step, updated as every run finishes, instead of the runs themselves.
+
+    Returns:
+        dict of scenario name -> ScenarioAggregate
+    '''
+
+    aggregates = {params['name']: ScenarioAggregate(max_steps, quantiles) for params in parameters_list}
+    for name, iteration, data in iter_runs(parameters_list, iterations, max_steps, processes, seed, display_progress, cache):
+        aggregates[name].update(data)
+    return aggregates
+
+
+def run_adaptive(parameters_list, max_steps, target_width=2.0, confidence=0.95, min_iterations=5, max_iterations=50, processes=None, seed=0, display_progress=True, cache=None):
+    '''
+    Run every scenario until the confidence interval of its percentage of lost cups per cup used at the
+    end of the run is narrower than target_width (in percentage points), or it has had max_iterations
+    runs. Free workers go to the scenario with the widest interval, so noisy scenarios get more runs
+    than quiet ones. The interval uses Student's t distribution, since a scenario may stop after a few runs.
+
+    Args:
+        target_width: full width of the confidence interval at which a scenario has converged
+        confidence: confidence level of the interval
+        min_iterations: runs per scenario before its interval is trusted
+        max_iterations: cap on the runs per scenario
+
+    Returns:
+        dict of scenario name -> DataFrame with the model variables of all iterations, in order of iteration,
+        as returned by run_scenarios
+    '''
+
+    import pandas as pd
+
+    names = [params['name'] for params in parameters_list]
+    assert len(set(names)) == len(names), "scenario names must be unique"
+
+    results = {name: {} for name in names}
+    stats = {name: RunningStats(1) for name in names} # end-of-run percentage lost
+    launched = dict.fromkeys(names, 0)
+    finished = Queue()
+
+    def add(name, iteration, data):
+        results[name][iteration] = data
+        end = data.iloc[-1]
+        stats[name].update(lost_ratio(end['Lost cups'], end['Total cups'], end['Reuse count']) * 100)
+
+    def width(name):
+        if stats[name].n < min_iterations:
+            return float('inf')
+        low, high = stats[name].interval(confidence, student=True) # few runs, t rather than normal
+        return high[0] - low[0]
+
+    def next_scenario():
+        # scenarios that need more runs than they have running, the widest interval first
+        running = {name: launched[name] - len(results[name]) for name in names}
+        open_ = [name for name in names if launched[name] < max_iterations
+                 and (len(results[name]) + running[name] < min_iterations or width(name) > target_width)]
+        return max(open_, key=lambda name: (width(name), -running[name]), default=None)
+
+    progress = tqdm(disable=not display_progress)
+    with Pool(processes) as pool:
+        busy = 0
+        while True:
+            # keep every worker busy
+            while busy < (processes or os.cpu_count()):
+                name = next_scenario()
+                if name is None:
+                    break
+                params = parameters_list[names.index(name)]
+                iteration = launched[name]
+                launched[name] += 1
+                run_seed = job_seed(seed, params, iteration)
+                key = cache.key(params, run_seed, max_steps) if cache is not None else None
+                data = cache.get(key) if cache is not None else None
+                if data is not None:
+                    data['Iteration'] = iteration
+                    add(name, iteration, data)
+                    progress.update()
+                    continue
+                pool.apply_async(run_job, ((name, iteration, params, max_steps, run_seed),),
+                                 callback=lambda result, key=key: finished.put((key, result)),
+                                 error_callback=lambda error: finished.put((None, error)))
+                busy += 1
+
+            if busy == 0:
+                break
+            key, result = finished.get()
+            busy -= 1
+            if isinstance(result, BaseException):
+                raise result
+            name, iteration, data = result
+            if cache is not None:
+                cache.put(key, data)
+            add(name, iteration, data)
+            progress.update()
+    progress.close()
+
+    return {name: pd.concat([results[name][iteration] for iteration in sorted(results[name])]) for name in names}
+
+
+def run_paired(parameters_list, iterations, max_steps, baseline=None, antithetic=False, confidence=0.95, processes=None, seed=0, display_progress=True, cache=None):
+    '''
+    Compare every scenario with a baseline using common random numbers: iteration i of every scenario runs
+    with the same seed and with separate random streams for the initial visitors, the activation order,
+    movement, the drop and collect decisions and the dirt of cups, so the runs only differ by the parameters.
+    With antithetic, every run is paired with a run on the mirrored random numbers and an iteration is the
+    mean of both.
+
+    Returns:
+        DataFrame per scenario and metric with the mean difference at the last step, its confidence interval
+        and the variance reduction compared with independent runs, see paired_differences
+    '''
+
+    baseline = baseline or parameters_list[0]['name']
+    param_set = [dict(params, crn=True) for params in parameters_list]
+    if antithetic:
+        param_set += [dict(params, name=params['name'] + ' (antithetic)', antithetic=True) for params in param_set]
+
+    finals = {params['name']: np.zeros((iterations, len(METRICS))) for params in param_set}
+    for name, iteration, data in iter_runs(param_set, iterations, max_steps, processes, seed, display_progress, cache, common_random_numbers=True):
+        finals[name][iteration] = final_metrics(data)
+    if antithetic:
+        finals = {params['name']: (finals[params['name']] + finals[params['name'] + ' (antithetic)']) / 2 for params in parameters_list}
+    return paired_differences(finals, baseline, confidence)
+
+
+def run_hotspots(parameters_list, iterations, max_steps, processes=None, seed=0, display_progress=True):
+    '''
+    Run every scenario a number of iterations with per cell counts of drops, pickups, cups on the floor and
+    traffic, with the seeds of run_scenarios, and merge the counts of the iterations of every scenario
+
+    Returns:
+        dict of scenario name -> CellAccumulators
+    '''
+
+    jobs = [(scenario, iteration, params, max_steps, job_seed(seed, params, iteration))
+            for scenario, params in enumerate(parameters_list) for iteration in range(iterations)]
+
+    merged = [None] * len(parameters_list)
+    with Pool(processes) as pool:
+        for scenario, hotspots in tqdm(pool.imap_unordered(hotspot_job, jobs), total=len(jobs), disable=not display_progress):
+            if merged[scenario] is None:
+                merged[scenario] = hotspots
+            else:
+                merged[scenario].merge(hotspots)
+    return {params['name']: hotspots for params, hotspots in zip(parameters_list, merged)}
+
+
+def run_profiled(parameters_list, iterations, max_steps, sample=10, processes=None, seed=0, display_progress=True):
+    '''
+    Run every scenario a number of iterations with profiling, and return the profile report of all runs
+    together, as returned by Festival.profile_report
+    '''
+
+    jobs = [(scenario, iteration, params, max_steps, job_seed(seed, params, iteration), sample)
+            for scenario, params in enumerate(parameters_list) for iteration in range(iterations)]
+
+    total = Profiler(sample)
+    with Pool(processes) as pool:
+        for profiler in tqdm(pool.imap_unordered(profile_job, jobs), total=len(jobs), disable=not display_progress):
+            total.merge(profiler)
+    return total.report()
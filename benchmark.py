@@ -0,0 +1,205 @@
+'''
+Benchmarks of Festival step throughput and scaling, and microbenchmarks of the agent methods.
+
+    python benchmark.py run [--quick] [--label NAME]     run the benchmarks and append them to the history
+    python benchmark.py compare [--baseline NAME] [--threshold 0.1]
+                                                         compare the last run with the previous one (or a label),
+                                                         exit with 1 if anything got slower than the threshold
+'''
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime
+from multiprocessing import Pool
+
+
+HISTORY = 'benchmarks.jsonl'
+
+# (engine, visitors, grid size, stands, steps)
+CASES = [
+    ('agents', 200, 15, 3, 200),
+    ('agents', 200, 15, 3, 2000),
+    ('agents', 1000, 50, 3, 200),
+    ('agents', 1000, 50, 10, 200),
+    ('agents', 10000, 150, 10, 100),
+    ('vectorized', 200, 15, 3, 200),
+    ('vectorized', 200, 15, 3, 2000),
+    ('vectorized', 10000, 150, 10, 200),
+    ('vectorized', 100000, 500, 10, 100),
+    ('vectorized', 100000, 500, 50, 100),
+]
+QUICK_CASES = [CASES[0], CASES[2], CASES[5], CASES[7]]
+
+
+def case_name(case):
+    engine, visitors, size, stands, steps = case
+    return f"{engine} N={visitors} grid={size}x{size} stands={stands} steps={steps}"
+
+
+def spread_stands(size, n):
+    '''Return n stand positions spread over a square grid'''
+
+    side = int(n ** 0.5 + 0.999)
+    cells = [(int((i + 0.5) * size / side), int((j + 0.5) * size / side)) for i in range(side) for j in range(side)]
+    return tuple(cells[:n])
+
+
+def run_case(case, rounds=3):
+    '''Run a single case a few rounds in a fresh process and return its best throughput and peak memory'''
+
+    from model import Festival
+
+    engine, visitors, size, stands, steps = case
+    best = float('inf')
+    for r in range(rounds):
+        model = Festival(visitors=visitors, width=size, height=size, stands=spread_stands(size, stands), engine=engine, seed=r)
+        start = time.perf_counter()
+        for i in range(steps):
+            model.step()
+        best = min(best, time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kilobytes on Linux
+    return {'steps_per_s': steps / best, 'peak_mb': peak}
+
+
+def time_calls(prepare, call, repeat=2000, rounds=5):
+    '''
+    Return the time of a call in microseconds, with prepare() run untimed before every call. The mean
+    over the fastest of a few rounds is taken, to keep noise from other processes out.
+    '''
+
+    best = float('inf')
+    for r in range(rounds):
+        total = 0
+        for i in range(repeat // rounds):
+            args = prepare()
+            start = time.perf_counter_ns()
+            call(*args)
+            total += time.perf_counter_ns() - start
+        best = min(best, total / (repeat // rounds))
+    return best / 1000
+
+
+def microbenchmarks():
+    '''Time the individual agent methods on a warmed-up default Festival'''
+
+    from agents import Visitor
+    from model import Festival
+
+    model = Festival(seed=0)
+    for i in range(200):
+        model.step()
+    visitors = [a for a in model.schedule.agents if isinstance(a, Visitor)]
+    rng = model.random
+
+    def visitor():
+        return (rng.choice(visitors),)
+
+    def with_empty_cup():
+        v = rng.choice(visitors)
+        v.cup = model.cups.create()
+        v.cup.full = 0
+        return (v,)
+
+    def pick_up_again():
+        # put a collected cup back, so the floor does not run out of cups
+        v = rng.choice(visitors)
+        if v.collected_cups:
+            cup = v.collected_cups.pop()
+            cup.drop()
+            model.grid.drop_cup(cup, v.pos)
+            model.cups_on_floor += 1
+        return (v,)
+
+    return {
+        'Visitor.step': time_calls(visitor, Visitor.step),
+        'Visitor.find_stand': time_calls(visitor, Visitor.find_stand),
+        'Visitor.random_move': time_calls(visitor, Visitor.random_move),
+        'Visitor.drop_cup': time_calls(with_empty_cup, Visitor.drop_cup),
+        'Visitor.collect_cup': time_calls(pick_up_again, Visitor.collect_cup),
+        'DataCollector.collect': time_calls(lambda: (model,), model.datacollector.collect),
+        'Festival.step': time_calls(lambda: (), model.step, repeat=200),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def run(args):
+    cases = QUICK_CASES if args.quick else CASES
+    results = {}
+    for case in cases:
+        # a fresh process per case, so the peak memory of one case does not carry over into the next
+        with Pool(1, maxtasksperchild=1) as pool:
+            results[case_name(case)] = pool.apply(run_case, (case,))
+        print(f"{case_name(case):55} {results[case_name(case)]['steps_per_s']:10.1f} steps/s {results[case_name(case)]['peak_mb']:8.1f} MB")
+
+    micro = microbenchmarks()
+    for name, us in micro.items():
+        print(f"{name:55} {us:10.2f} us/call")
+
+    record = {'time': datetime.now().isoformat(timespec='seconds'), 'label': args.label, 'commit': git_commit(),
+              'python': sys.version.split()[0], 'cases': results, 'micro': micro}
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def compare(args):
+    with open(args.history) as f:
+        history = [json.loads(line) for line in f if line.strip()]
+    if len(history) < 2:
+        sys.exit("need at least two runs in " + args.history)
+
+    current = history[-1]
+    if args.baseline is None:
+        baseline = history[-2]
+    else:
+        matches = [r for r in history[:-1] if r['label'] == args.baseline]
+        if not matches:
+            sys.exit("no run labelled " + repr(args.baseline))
+        baseline = matches[-1]
+
+    print("comparing", current['commit'] or current['time'], "with", baseline['commit'] or baseline['time'])
+    slower = []
+    for name, result in current['cases'].items():
+        if name in baseline['cases']:
+            change = result['steps_per_s'] / baseline['cases'][name]['steps_per_s'] - 1
+            flag = change < -args.threshold
+            print(f"{name:55} {change:+7.1%} steps/s {'SLOWER' if flag else ''}")
+            if flag:
+                slower.append(name)
+    for name, us in current['micro'].items():
+        if name in baseline['micro']:
+            change = us / baseline['micro'][name] - 1
+            flag = change > args.threshold
+            print(f"{name:55} {change:+7.1%} time/call {'SLOWER' if flag else ''}")
+            if flag:
+                slower.append(name)
+
+    if slower:
+        sys.exit(str(len(slower)) + " benchmarks slower than the threshold of " + format(args.threshold, '.0%'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Festival benchmarks")
+    parser.add_argument('--history', default=HISTORY, help="file with the benchmark history, one JSON record per run")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="run the benchmarks and append them to the history")
+    run_parser.add_argument('--quick', action='store_true', help="only run a few small cases")
+    run_parser.add_argument('--label', default='', help="name of this run, to compare against later")
+    compare_parser = commands.add_parser('compare', help="compare the last run with an earlier one")
+    compare_parser.add_argument('--baseline', help="label of the run to compare with, defaults to the previous run")
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help="relative slowdown that is flagged")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+    else:
+        compare(args)
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import pickle
+import sys
+from pathlib import Path
+
+
+# modules that define the behaviour of a Festival run, a change in any of them invalidates the cache
+MODEL_SOURCES = ('model.py', 'agents.py', 'space.py', 'vectorized.py', 'events.py', 'collector.py', 'scheduler.py', 'streams.py')
+
+
+def source_hash():
+    '''Return a hash of the source of the model'''
+
+    digest = hashlib.sha256()
+    for name in MODEL_SOURCES:
+        digest.update((Path(__file__).parent / name).read_bytes())
+    return digest.hexdigest()
+
+
+def params_digest(params):
+    '''Return a stable hash of the Festival parameters of a scenario, its name excluded'''
+
+    params = {k: v for k, v in params.items() if k != 'name'}
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+class ResultCache:
+    '''
+    On-disk cache of the model variables of single runs. A run is found by a hash of its Festival parameters,
+    seed, number of steps and the source of the model. When the cache grows beyond max_bytes the least
+    recently used runs are removed.
+    '''
+
+    def __init__(self, directory='.cache', max_bytes=2 ** 30):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.source = source_hash()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def key(self, params, seed, steps):
+        '''Return the key of a run'''
+
+        run = json.dumps([params_digest(params), seed, steps, self.source])
+        return hashlib.sha256(run.encode()).hexdigest()
+
+    def get(self, key):
+        '''Return the cached result of a run, or None'''
+
+        path = self.directory / (key + '.pkl')
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        os.utime(path) # mark as recently used
+        return data
+
+    def put(self, key, data):
+        '''Store the result of a run'''
+
+        path = self.directory / (key + '.pkl')
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        self.evict()
+
+    def files(self):
+        '''Return the cached files, least recently used first'''
+
+        return sorted(self.directory.glob('*.pkl'), key=lambda p: p.stat().st_mtime)
+
+    def size(self):
+        '''Return the size of the cache in bytes'''
+
+        return sum(p.stat().st_size for p in self.files())
+
+    def evict(self):
+        '''Remove the least recently used runs until the cache fits in max_bytes'''
+
+        files = self.files()
+        total = sum(p.stat().st_size for p in files)
+        for path in files:
+            if total <= self.max_bytes:
+                break
+            total -= path.stat().st_size
+            path.unlink()
+
+    def clear(self):
+        '''Remove all cached runs'''
+
+        for path in self.files():
+            path.unlink()
+
+
+# Invalidate with: python cache.py clear [directory]
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'info'
+    cache = ResultCache(*sys.argv[2:3])
+    if command == 'clear':
+        cache.clear()
+        print("cache cleared")
+    elif command == 'info':
+        print(len(cache.files()), "runs,", round(cache.size() / 2 ** 20, 1), "MB in", cache.directory)
+    else:
+        sys.exit("usage: python cache.py [info|clear] [directory]")
@@ -0,0 +1,140 @@
+import os
+import pickle
+import zlib
+from multiprocessing import Pool
+
+import pandas as pd
+
+from batch import job_seed
+from model import Festival
+
+
+MAGIC = b'FESTIVAL-CHECKPOINT-1\n'
+
+
+def dumps(model):
+    '''Return a compact binary snapshot of a Festival: agents, grid, cups, stands, counters, RNG state and collected data'''
+
+    # the timed methods of a profiler are local functions, pickle the plain methods and wrap them again
+    if model.profiler is not None:
+        model.profiler.detach()
+    try:
+        data = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        if model.profiler is not None:
+            model.profiler.attach(model)
+    return MAGIC + zlib.compress(data)
+
+
+def loads(snapshot):
+    '''Return the Festival from a snapshot made by dumps'''
+
+    if not snapshot.startswith(MAGIC):
+        raise ValueError("not a Festival checkpoint")
+    model = pickle.loads(zlib.decompress(snapshot[len(MAGIC):]))
+    if model.profiler is not None: # keeps its timings, goes on timing the loaded model
+        model.profiler.attach(model)
+    return model
+
+
+def save_checkpoint(model, path):
+    '''Write a snapshot of a Festival to a file, replacing an older checkpoint only once the new one is complete'''
+
+    tmp = str(path) + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(dumps(model))
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path):
+    '''Return the Festival from a checkpoint file'''
+
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def fork(snapshot, seed=None, **changes):
+    '''
+    Return a new Festival that continues from a snapshot, with some of its attributes changed,
+    e.g. fork(snapshot, awareness=0.08, name='Variation 4').
+
+    Without a seed the fork continues with the random state of the snapshot, so forks with the same
+    changes follow the same path. With a seed its random generators are reseeded.
+    '''
+
+    model = loads(snapshot)
+    for name, value in changes.items():
+        if not hasattr(model, name):
+            raise AttributeError("Festival has no attribute " + repr(name))
+        setattr(model, name, value)
+    if seed is not None:
+        model.reseed(seed)
+    return model
+
+
+def run_with_checkpoints(path, steps, every=100, **params):
+    '''
+    Run a Festival for a number of steps, writing a checkpoint every few steps. If the checkpoint
+    already exists the run resumes from it, e.g. after a crash.
+    '''
+
+    if os.path.exists(path):
+        model = load_checkpoint(path)
+    else:
+        model = Festival(**params)
+
+    while model.schedule.steps < steps:
+        model.step()
+        if model.schedule.steps % every == 0 or model.schedule.steps == steps:
+            save_checkpoint(model, path)
+    return model
+
+
+def run_branches(job):
+    '''Warm up a single iteration of the base case and run every branch from the shared state'''
+
+    base, branches, warmup, max_steps, seed, iteration = job
+    model = Festival(seed=seed, **base)
+    for i in range(warmup):
+        model.step()
+    snapshot = dumps(model)
+
+    results = []
+    for changes in branches:
+        branch = fork(snapshot, **changes)
+        for i in range(warmup, max_steps):
+            branch.step()
+        branch.datacollector.finish() # downsampled runs end with the last step
+        data = branch.datacollector.get_model_vars_dataframe()
+        branch.datacollector.close()
+        data.index.name = 'Step'
+        data['Iteration'] = iteration
+        results.append(data)
+    model.datacollector.close() # the branches copied the spill file when they were loaded
+    return iteration, results
+
+
+def run_forked(base, branches, warmup, iterations, max_steps, processes=None, seed=0):
+    '''
+    Run scenarios that only differ after a warm-up period. Every iteration runs the warm-up of the base
+    case once and forks all branches from it, in parallel over the iterations.
+
+    Args:
+        base: dict with the Festival parameters of the base case
+        branches: list of dicts with the attributes that change after the warm-up, each with a unique 'name'
+        warmup: number of steps shared by all branches
+        iterations: number of runs per branch
+        max_steps: number of steps per run, warm-up included
+
+    Returns:
+        dict of branch name -> DataFrame with the model variables of all iterations, like run_scenarios
+    '''
+
+    jobs = [(base, branches, warmup, max_steps, job_seed(seed, base, iteration), iteration) for iteration in range(iterations)]
+    results = {}
+    with Pool(processes) as pool:
+        for iteration, data in pool.imap_unordered(run_branches, jobs):
+            results[iteration] = data
+
+    return {changes['name']: pd.concat([results[iteration][i] for iteration in range(iterations)])
+            for i, changes in enumerate(branches)}
@@ -0,0 +1,212 @@
+import os
+import tempfile
+import weakref
+from operator import attrgetter
+
+import numpy as np
+
+
+AGGREGATES = {'mean': np.mean, 'min': np.min, 'max': np.max}
+
+
+def remove_spill(path, pid):
+    '''Delete a spill file, only in the process that made it, so a forked worker does not delete the file of its parent'''
+
+    if os.getpid() == pid:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class ModelCollector:
+    '''
+    Collects model level variables every step, like the DataCollector of mesa with only model reporters,
+    but without importing pandas until a DataFrame is asked for. Keeps the model_vars dict of lists and
+    get_model_vars_dataframe of the mesa DataCollector, so it can take its place.
+
+    For long runs the memory can be bounded: only one row per window of every steps is kept, with the
+    values at the last step of the window and optionally their mean, min and max over the window. Rows can
+    go to a ring buffer that keeps the last capacity rows, or be spilled to a file on disk in chunks. Rows
+    are labelled with the step they were recorded at, so plots against the index stay in steps. At the end
+    of a run, finish records the last, partial window, so the last step is always recorded, and close
+    deletes the spill file once the rows have been read.
+    '''
+
+    def __init__(self, model_reporters, every=1, aggregate=None, capacity=None, spill=None, chunk=1024):
+        '''
+        Creates a new collector
+
+        Args:
+            model_reporters: dict of variable name -> attribute name of the model, or function of the model
+            every: record one row per this many steps
+            aggregate: 'mean', 'min', 'max' or a tuple of them, added as columns 'name (mean)' etc. with the
+                values over the window. The columns named after the variables always hold the values at the
+                last step of the window, so batch results keep their meaning.
+            capacity: keep only the last capacity rows in memory
+            spill: directory in which a new file is made to which rows are written in chunks, keeping at most
+                chunk rows in memory
+        '''
+
+        if capacity is not None and spill is not None:
+            raise ValueError("rows go either to a ring buffer (capacity) or to disk (spill), not both")
+        if isinstance(aggregate, str):
+            aggregate = (aggregate,)
+        for name in aggregate or ():
+            if name not in AGGREGATES:
+                raise ValueError("aggregate must be one of " + ", ".join(AGGREGATES) + ", not " + repr(name))
+
+        self.model_reporters = {name: attrgetter(reporter) if isinstance(reporter, str) else reporter
+                                for name, reporter in model_reporters.items()}
+        self.every = every
+        self.aggregate = tuple(aggregate) if aggregate else None
+        self.capacity = capacity
+        self.spill = None
+        self.chunk = chunk
+        self.steps = 0 # steps collected
+        self.rows = 0 # rows recorded
+
+        # the columns of a row, per variable its value and its aggregates
+        self.columns = [column for name in model_reporters
+                        for column in (name, *(name + ' (' + a + ')' for a in self.aggregate or ()))]
+
+        # unbounded rows at every step are kept as lists, as in mesa
+        self.plain = every == 1 and self.aggregate is None and capacity is None and spill is None
+        if self.plain:
+            self.model_vars = {name: [] for name in model_reporters}
+            return
+
+        self.window = [] # values of the steps of the current window
+        self.buffer = [] # rows in memory, as [step, *columns]
+        if capacity is not None:
+            self.ring = np.zeros((capacity, 1 + len(self.columns))) # step and columns
+        if spill is not None:
+            os.makedirs(spill, exist_ok=True)
+            handle, self.spill = tempfile.mkstemp(suffix='.f8', prefix='model_vars-', dir=spill) # one file per model
+            os.close(handle)
+            self.finalizer = weakref.finalize(self, remove_spill, self.spill, os.getpid()) # if close is never called
+
+    def __getstate__(self):
+        '''Note the rows in the spill file, so a collector loaded from a pickle can copy them to a file of its own'''
+
+        state = self.__dict__.copy()
+        if self.spill is not None:
+            self.check_open()
+            state['spilled'] = self.rows - len(self.buffer)
+            del state['finalizer']
+        return state
+
+    def __setstate__(self, state):
+        spilled = state.pop('spilled', None)
+        self.__dict__.update(state)
+        if spilled is not None: # e.g. a fork or a resumed checkpoint, do not append to the file of the original
+            source = self.spill
+            handle, self.spill = tempfile.mkstemp(suffix='.f8', prefix='model_vars-', dir=os.path.dirname(source))
+            with os.fdopen(handle, 'wb') as f, open(source, 'rb') as original:
+                f.write(original.read(spilled * 8 * (1 + len(self.columns))))
+            self.finalizer = weakref.finalize(self, remove_spill, self.spill, os.getpid())
+
+    def collect(self, model):
+        '''Record the current value of every model variable'''
+
+        if self.plain:
+            for name, reporter in self.model_reporters.items():
+                self.model_vars[name].append(reporter(model))
+            self.steps += 1
+            self.rows += 1
+            return
+
+        self.window.append([reporter(model) for reporter in self.model_reporters.values()])
+        self.steps += 1
+        if self.steps % self.every == 0:
+            self.record(self.steps - 1, self.reduce(self.window))
+            self.window = []
+
+    def finish(self):
+        '''Record the last window if it is partial, at the end of a run'''
+
+        if not self.plain and self.window:
+            self.record(self.steps - 1, self.reduce(self.window))
+            self.window = []
+
+    def close(self):
+        '''Delete the spill file, when the rows are no longer needed'''
+
+        if self.spill is not None:
+            self.finalizer()
+
+    def check_open(self):
+        if not self.finalizer.alive:
+            raise ValueError("the collector is closed, its spill file has been deleted")
+
+    def reduce(self, window):
+        '''Return the row of a window of values, a list per step'''
+
+        if self.aggregate is None:
+            return window[-1]
+        values = np.array(window, dtype=float)
+        return np.stack([values[-1], *(AGGREGATES[a](values, axis=0) for a in self.aggregate)], axis=1).ravel().tolist()
+
+    def record(self, step, row):
+        if self.capacity is not None:
+            self.ring[self.rows % self.capacity] = [step, *row]
+        elif self.spill is not None:
+            self.buffer.append([step, *row])
+            if len(self.buffer) >= self.chunk:
+                self.flush()
+        else:
+            self.buffer.append([step, *row])
+        self.rows += 1
+
+    def flush(self):
+        '''Write the rows in memory to the spill file'''
+
+        if self.spill is not None and self.buffer:
+            self.check_open()
+            with open(self.spill, 'ab') as f:
+                f.write(np.array(self.buffer, dtype='<f8').tobytes())
+            self.buffer = []
+
+    def last(self):
+        '''Return the last recorded row, in the order of the columns'''
+
+        if self.plain:
+            return [values[-1] for values in self.model_vars.values()]
+        if self.capacity is not None:
+            return self.ring[(self.rows - 1) % self.capacity, 1:].tolist()
+        if self.buffer:
+            return self.buffer[-1][1:]
+        self.check_open()
+        with open(self.spill, 'rb') as f:
+            f.seek(-8 * (1 + len(self.columns)), os.SEEK_END)
+            return np.frombuffer(f.read(), dtype='<f8')[1:].tolist()
+
+    def table(self):
+        '''Return the steps and the rows that are kept, as arrays'''
+
+        if self.capacity is not None:
+            if self.rows > self.capacity: # oldest row first
+                table = np.roll(self.ring, -(self.rows % self.capacity), axis=0)
+            else:
+                table = self.ring[:self.rows]
+        else:
+            parts = []
+            if self.spill is not None:
+                self.check_open()
+                parts.append(np.fromfile(self.spill, dtype='<f8').reshape(-1, 1 + len(self.columns)))
+            parts.append(np.array(self.buffer, dtype=float).reshape(-1, 1 + len(self.columns)))
+            table = np.concatenate(parts)
+        return table[:, 0].astype(np.int64), table[:, 1:]
+
+    def get_model_vars_dataframe(self):
+        '''Return a DataFrame with a row per recorded step and a column per model variable, indexed by step'''
+
+        import pandas as pd
+
+        if self.plain:
+            return pd.DataFrame(self.model_vars)
+        steps, values = self.table()
+        data = pd.DataFrame(values, columns=self.columns, index=pd.Index(steps, name='Step'))
+        if self.aggregate is None:
+            data = data.astype(np.int64)
+        return data
@@ -0,0 +1,132 @@
+'''
+Check that the vectorized engine is statistically equivalent to the agent engine: both run the same seeds
+of the default Festival, and the final Lost cups, Total cups and Reuse count must agree within the margins
+below, in mean and in spread over the runs.
+
+    python equivalence.py [--seeds 2000] [--steps 200] [--first-seed 0] [--processes N]
+                                                         exit with 1 if any column is not equivalent
+
+The means are compared with two one-sided tests (TOST): the 90% confidence interval of the difference
+(vectorized - agents) must lie within +- MARGINS of the agent mean. The spreads are compared the same way
+on the log of the ratio of standard deviations, which must lie within +- log(SPREAD_MARGIN). A run that
+is too small to show equivalence fails, so the margins are meant for the default number of seeds.
+
+At the default 2000 seeds the margins are 3.4 to 4 standard errors of the difference (0.45 lost cups,
+1.8 total cups and 2.3 reuses). Equivalent engines then pass on about nine seed ranges out of ten, a
+bias of half the margin (2.5% of the lost cups) fails on about half of them and a bias of the whole
+margin on nearly all.
+'''
+
+import argparse
+import math
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+
+from aggregate import t_quantile
+
+
+COLUMNS = ('Lost cups', 'Total cups', 'Reuse count')
+
+# equivalence margins for the difference of the means, relative to the agent mean; at 200 steps the
+# standard deviation over runs is about 15 lost cups (mean 30), 56 total cups (415) and 72 reuses (1870)
+MARGINS = {'Lost cups': 0.05, 'Total cups': 0.015, 'Reuse count': 0.005}
+
+# equivalence margin for the ratio of the standard deviations
+SPREAD_MARGIN = 1.1
+
+CONFIDENCE = 0.90 # two one-sided tests at 5% each
+
+
+def run_seed(job):
+    '''Run the default Festival on an engine and return the final value of every column'''
+
+    from model import Festival
+
+    engine, seed, steps = job
+    model = Festival(engine=engine, seed=seed)
+    for i in range(steps):
+        model.step()
+    return [model.cups_on_floor, model.cup_count, model.reuse_count]
+
+
+def run_engine(engine, seeds, steps, processes=None):
+    '''Return an array of the final values, a row per seed and a column per entry of COLUMNS'''
+
+    with Pool(processes) as pool:
+        return np.array(pool.map(run_seed, [(engine, seed, steps) for seed in seeds]), dtype=float)
+
+
+def equivalent_means(agents, vectorized, margin):
+    '''
+    Return the difference of the means, its confidence interval (Welch) and whether the interval lies
+    within +- margin
+    '''
+
+    var_a = agents.var(ddof=1) / agents.size
+    var_v = vectorized.var(ddof=1) / vectorized.size
+    se = math.sqrt(var_a + var_v)
+    difference = vectorized.mean() - agents.mean()
+    if se == 0:
+        return difference, (difference, difference), abs(difference) <= margin
+    df = (var_a + var_v) ** 2 / (var_a ** 2 / (agents.size - 1) + var_v ** 2 / (vectorized.size - 1))
+    half = t_quantile(int(df), CONFIDENCE) * se
+    low, high = difference - half, difference + half
+    return difference, (low, high), -margin <= low and high <= margin
+
+
+def equivalent_spreads(agents, vectorized, margin):
+    '''
+    Return the ratio of the standard deviations (vectorized / agents), its confidence interval and whether
+    the interval lies within [1 / margin, margin]. The log of a sample standard deviation has a standard
+    error of about 1 / sqrt(2 (n - 1)).
+    '''
+
+    sd_a, sd_v = agents.std(ddof=1), vectorized.std(ddof=1)
+    if sd_a == 0 or sd_v == 0:
+        return float('nan'), (float('nan'), float('nan')), sd_a == sd_v
+    log_ratio = math.log(sd_v / sd_a)
+    se = math.sqrt(1 / (2 * (agents.size - 1)) + 1 / (2 * (vectorized.size - 1)))
+    half = t_quantile(agents.size + vectorized.size - 2, CONFIDENCE) * se
+    low, high = math.exp(log_ratio - half), math.exp(log_ratio + half)
+    return math.exp(log_ratio), (low, high), 1 / margin <= low and high <= margin
+
+
+def check(seeds, steps, processes=None):
+    '''Run both engines and print the comparison of every column, return the names of the columns that fail'''
+
+    finals = {engine: run_engine(engine, seeds, steps, processes) for engine in ('agents', 'vectorized')}
+    print(f"{len(seeds)} seeds x {steps} steps, {CONFIDENCE:.0%} intervals")
+    print(f"{'':12} {'agents':>16} {'vectorized':>16} {'difference':>26} {'sd ratio':>22}")
+
+    failed = []
+    for i, column in enumerate(COLUMNS):
+        agents, vectorized = finals['agents'][:, i], finals['vectorized'][:, i]
+        margin = MARGINS[column] * abs(agents.mean())
+        difference, (low, high), means_ok = equivalent_means(agents, vectorized, margin)
+        ratio, (ratio_low, ratio_high), spreads_ok = equivalent_spreads(agents, vectorized, SPREAD_MARGIN)
+        se_a = agents.std(ddof=1) / math.sqrt(agents.size)
+        se_v = vectorized.std(ddof=1) / math.sqrt(vectorized.size)
+        print(f"{column:12} {agents.mean():9.2f} +-{se_a:5.2f} {vectorized.mean():9.2f} +-{se_v:5.2f} "
+              f"{difference:+8.2f} [{low:+7.2f}, {high:+7.2f}] {'ok' if means_ok else 'FAIL':4} "
+              f"{ratio:5.2f} [{ratio_low:4.2f}, {ratio_high:4.2f}] {'ok' if spreads_ok else 'FAIL'}")
+        if not means_ok:
+            failed.append(column + " (mean, margin +-" + format(margin, '.2f') + ")")
+        if not spreads_ok:
+            failed.append(column + " (spread)")
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Equivalence check of the vectorized and the agent engine")
+    parser.add_argument('--seeds', type=int, default=2000, help="number of runs per engine, the margins hold for the default")
+    parser.add_argument('--steps', type=int, default=200, help="steps per run")
+    parser.add_argument('--first-seed', type=int, default=0, help="seed of the first run, the others follow")
+    parser.add_argument('--processes', type=int, help="worker processes, defaults to the number of cores")
+    args = parser.parse_args()
+
+    failed = check(range(args.first_seed, args.first_seed + args.seeds), args.steps, args.processes)
+    if failed:
+        sys.exit("not equivalent: " + ", ".join(failed))
+    print("equivalent")
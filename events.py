@@ -0,0 +1,105 @@
+import numpy as np
+
+
+# event types
+DROP, COLLECT, RETURN, BUY = range(4)
+EVENT_NAMES = ('drop', 'collect', 'return', 'buy')
+
+# log levels
+SILENT = 0 # nothing is recorded
+EVENTS = 1 # events are recorded in the buffer
+VERBOSE = 2 # events are also printed, and visitor v1 reports everything it does
+
+EVENT_DTYPE = np.dtype([('time', np.int64), ('kind', np.int8), ('agent', np.int64), ('x', np.int32), ('y', np.int32)])
+
+
+class EventLog:
+    '''
+    Log of the cup events of a Festival (drop, collect, return, buy). Events are stored as rows of a
+    preallocated structured array. When the buffer is full it is handed to the sink in one piece, or,
+    without a sink, the oldest events are overwritten.
+
+    Call sites check log.active[kind] before recording, so a disabled log costs a single tuple lookup.
+    '''
+
+    def __init__(self, level=SILENT, kinds=EVENT_NAMES, capacity=4096, sink=None):
+        '''
+        Creates a new event log
+
+        Args:
+            level: SILENT, EVENTS or VERBOSE
+            kinds: names of the event types to record
+            capacity: number of events the buffer holds
+            sink: optional function that receives every full buffer as a structured array
+        '''
+
+        self.level = level
+        self.active = tuple(level >= EVENTS and name in kinds for name in EVENT_NAMES)
+        self.buffer = np.zeros(capacity, dtype=EVENT_DTYPE)
+        self.sink = sink
+        self.size = 0 # number of events in the buffer
+        self.total = 0 # number of events recorded
+
+    def __getstate__(self):
+        '''The sink is left out of pickles, e.g. checkpoints'''
+
+        state = self.__dict__.copy()
+        state['sink'] = None
+        return state
+
+    def record(self, kind, time, agent, pos):
+        '''Record a single event'''
+
+        i = self.total % len(self.buffer)
+        self.buffer[i] = (time, kind, agent, pos[0], pos[1])
+        self.total += 1
+        self.size = min(self.size + 1, len(self.buffer))
+        if self.level >= VERBOSE:
+            print("t =", time, ",", EVENT_NAMES[kind], "by", agent, "at", tuple(pos))
+        if self.size == len(self.buffer) and self.sink is not None:
+            self.flush()
+
+    def record_many(self, kind, time, agents, x, y):
+        '''Record an event for every agent in an array, e.g. from the vectorized engine'''
+
+        start = 0
+        while start < len(agents):
+            room = len(self.buffer) - self.size if self.sink is not None else len(self.buffer)
+            part = slice(start, start + room)
+            n = len(agents[part])
+            rows = (self.total + np.arange(n)) % len(self.buffer)
+            self.buffer['time'][rows] = time
+            self.buffer['kind'][rows] = kind
+            self.buffer['agent'][rows] = agents[part]
+            self.buffer['x'][rows] = x[part]
+            self.buffer['y'][rows] = y[part]
+            self.total += n
+            self.size = min(self.size + n, len(self.buffer))
+            start += n
+            if self.size == len(self.buffer) and self.sink is not None:
+                self.flush()
+        if self.level >= VERBOSE:
+            for agent, pos in zip(agents, zip(x, y)):
+                print("t =", time, ",", EVENT_NAMES[kind], "by", agent, "at", pos)
+
+    def events(self):
+        '''Return the buffered events, oldest first'''
+
+        start = (self.total - self.size) % len(self.buffer)
+        return np.roll(self.buffer, -start)[:self.size]
+
+    def flush(self):
+        '''Hand the buffered events to the sink and empty the buffer'''
+
+        if self.sink is not None and self.size > 0:
+            self.sink(self.events().copy())
+        self.size = 0
+
+    def to_dataframe(self):
+        '''Return the buffered events as a DataFrame'''
+
+        import pandas as pd
+
+        df = pd.DataFrame(self.events())
+        df['kind'] = pd.Categorical.from_codes(df['kind'], EVENT_NAMES)
+        return df
@@ -0,0 +1,72 @@
+import numpy as np
+
+
+# the per cell counts: cups dropped, cups collected from the floor, steps cups spent on the floor (cup-steps)
+# and visitor moves into the cell
+FIELDS = ('drops', 'pickups', 'dwell', 'traffic')
+
+
+class CellAccumulators:
+    '''
+    Running per cell counts of litter and traffic of a Festival, indexed [x, y] like the grid. The grid and
+    VisitorArrays add to them where cups are dropped, collected and visitors move, and the model adds the
+    cups on the floor once per step, so finding hotspots does not need the agent positions of every step.
+    Accumulators of several runs can be merged, e.g. over the iterations of a batch.
+    '''
+
+    def __init__(self, width, height):
+        self.shape = (width, height)
+        self.runs = 1 # runs merged into the counts
+        for name in FIELDS:
+            setattr(self, name, np.zeros(self.shape, dtype=np.int64))
+
+    def add(self, field, x, y):
+        '''Count an event of a field at every cell given by the arrays x and y, single events are counted by indexing the field directly'''
+
+        counts = getattr(self, field)
+        counts += np.bincount(x * self.shape[1] + y, minlength=counts.size).reshape(self.shape)
+
+    def step(self, floor):
+        '''Add a step of the cups on the floor, counted per cell'''
+
+        self.dwell += floor
+
+    def merge(self, other):
+        '''Add the counts of another run, or of other merged runs, to these'''
+
+        if other.shape != self.shape:
+            raise ValueError("cannot merge counts of a " + "x".join(map(str, other.shape)) + " grid into a " + "x".join(map(str, self.shape)) + " grid")
+        for name in FIELDS:
+            getattr(self, name)[...] += getattr(other, name)
+        self.runs += other.runs
+
+    def mean(self, field):
+        '''Return the counts of a field per run'''
+
+        return getattr(self, field) / self.runs
+
+    def to_frame(self):
+        '''Return a DataFrame with a row per cell and the counts per run of every field as columns'''
+
+        import pandas as pd
+
+        x, y = np.indices(self.shape)
+        frame = pd.DataFrame({name: self.mean(name).ravel() for name in FIELDS},
+                             index=pd.MultiIndex.from_arrays([x.ravel(), y.ravel()], names=['x', 'y']))
+        return frame
+
+    def save(self, path):
+        '''Write the counts to a compressed .npz file'''
+
+        np.savez_compressed(path, runs=self.runs, **{name: getattr(self, name) for name in FIELDS})
+
+
+def load_hotspots(path):
+    '''Return the CellAccumulators saved to a .npz file'''
+
+    with np.load(path) as data:
+        hotspots = CellAccumulators(*data['drops'].shape)
+        hotspots.runs = int(data['runs'])
+        for name in FIELDS:
+            getattr(hotspots, name)[...] = data[name]
+    return hotspots
@@ -1,76 +1,259 @@
-import pandas as pd
+'''
+Command line entry point of the festival model.
 
-from visualize import visualize_model, visualize_batch
-from mesa.batchrunner import FixedBatchRunner
-from model import Festival
+    python main.py run [--scenario NAME] [--steps 200] [--plot] [--replay replay.gif] [--profile] [--hotspots]
+                                             run one scenario, fast
+    python main.py batch [--mode memory|store|aggregate|adaptive|paired|queue|hotspots] [--iterations 10] [--save results.pkl] [--no-plot]
+                                             compare the scenarios, more computation
+    python main.py plot SOURCE               plot the results of a batch, saved with --save or a result store
+    python workqueue.py work queue.db        help with a batch --mode queue, from any host that shares the file
 
+Scenarios are read from a TOML or JSON file (--config, scenarios.toml next to this file by default). Plotting and dataframe
+libraries are only imported by the commands that need them, so short runs start quickly.
+'''
 
-# Run (shift + F10)
-if __name__ == '__main__':
+import argparse
+import json
+import sys
+from pathlib import Path
+
+
+def load_config(path):
+    '''Return the batch settings and scenarios of a TOML or JSON config file'''
+
+    if str(path).endswith('.json'):
+        with open(path) as f:
+            return json.load(f)
+    import tomllib
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+
+def festival_params(params):
+    '''Return the parameters of a scenario as Festival expects them, with the stands as tuples'''
+
+    params = dict(params)
+    if 'stands' in params:
+        params['stands'] = tuple(tuple(pos) for pos in params['stands'])
+    return params
+
+
+def scenarios(config, policy=True):
+    '''
+    Return the list of scenarios of a config: the base case, followed by a copy of the base case for every
+    variation with the varied values inserted. Without policy, a cup is worth no drinks in any scenario.
+    '''
+
+    base = festival_params(config.get('base', {}))
+    base.setdefault('name', 'Base case')
+    param_set = [base]
+    for variation in config.get('variations', []):
+        d = base.copy() # copying is necessary to make the dicts unique objects
+        d.update(festival_params(variation))
+        param_set.append(d)
+    if not policy:
+        for d in param_set:
+            d['drinks_for_cup'] = 0
+    return param_set
+
+
+def run(args, config):
+    from model import Festival
+
+    params = {d['name']: d for d in scenarios(config, args.policy)}
+    if args.scenario not in params:
+        sys.exit("no scenario " + repr(args.scenario) + " in " + args.config + ", choose from " + ", ".join(params))
+    steps = args.steps or config.get('steps', 200)
+
+    model = Festival(seed=args.seed, engine=args.engine, profile=args.profile, replay=args.replay is not None, hotspots=args.hotspots, **params[args.scenario])
+    for i in range(steps):
+        model.step()
+
+    used = model.cup_count + model.reuse_count
+    print(args.scenario, "after", steps, "steps: lost cups", model.cups_on_floor, "total cups", model.cup_count,
+          "reuse count", model.reuse_count, "cups lost per cup used", str(round(model.cups_on_floor / used * 100, 1) if used else 0) + "%")
+
+    if args.profile:
+        print(model.profile_report().to_string())
+    if args.replay is not None:
+        from replay import render_replay
+        render_replay(model.replay, args.replay, title=args.scenario)
+    if args.hotspots:
+        from visualize import visualize_hotspots
+        visualize_hotspots(model.hotspots, save=True, show=args.plot)
+    if args.plot:
+        from visualize import visualize_model
+        visualize_model(model, save=True, show=True)
+
+
+def batch(args, config):
+    from cache import ResultCache
+
+    param_set = scenarios(config, args.policy)
+    iterations = args.iterations or config.get('iterations', 10)
+    steps = args.steps or config.get('steps', 200)
+    cache = ResultCache(args.cache) if args.cache else None
+    seed = args.seed or 0
+
+    if args.mode == 'store':
+        # execute batch run, streaming every step to disk
+        from batch import run_to_store
+        from store import ResultStore
+        store = run_to_store(param_set, iterations=iterations, max_steps=steps, store=ResultStore(args.store), processes=args.processes, seed=seed)
+        if args.plot:
+            from visualize import visualize_batch
+            visualize_batch(store, steps)
+        return
 
-    manual_run = False # run one scenario, fast
-    batch_experiment = True # compare scenarios, more computation
-    policy_switch = True # Whether to run with or without policy
-
-    if manual_run:
-        model = Festival()
-        for i in range(200):
-            model.step()
-        visualize_model(model)
-
-    if batch_experiment:
-        batch_size = 10
-        steps = 200
-        if policy_switch:
-            policy = 1
+    if args.mode == 'aggregate':
+        # execute batch run, aggregating every run as it finishes
+        from batch import run_aggregated
+        aggregates = run_aggregated(param_set, iterations=iterations, max_steps=steps, processes=args.processes, seed=seed, cache=cache)
+        if args.plot:
+            from visualize import visualize_aggregates
+            visualize_aggregates(aggregates)
+        return
+
+    if args.mode == 'paired':
+        # execute batch run with common random numbers, comparing every scenario with the base case
+        from batch import run_paired
+        differences = run_paired(param_set, iterations=iterations, max_steps=steps, antithetic=args.antithetic, processes=args.processes, seed=seed, cache=cache)
+        print(differences.to_string())
+        if args.save:
+            if args.save.endswith('.csv'):
+                differences.to_csv(args.save)
+            else:
+                differences.to_pickle(args.save)
+        return
+
+    if args.mode == 'hotspots':
+        # execute batch run, counting drops, pickups, cups on the floor and traffic per cell
+        import pandas as pd
+        from batch import run_hotspots
+        hotspots = run_hotspots(param_set, iterations=iterations, max_steps=steps, processes=args.processes, seed=seed)
+        df = pd.concat({name: counts.to_frame() for name, counts in hotspots.items()}, names=['Scenario'])
+        print(df.groupby(level='Scenario', sort=False, group_keys=False).apply(lambda cells: cells.nlargest(3, 'drops'))) # the worst cells
+        if args.save:
+            if args.save.endswith('.csv'):
+                df.to_csv(args.save)
+            else:
+                df.to_pickle(args.save)
+        if args.plot:
+            from visualize import visualize_hotspots
+            visualize_hotspots(hotspots, save=True, show=True)
+        return
+
+    if args.mode == 'adaptive':
+        # execute batch run, giving more iterations to the noisy scenarios
+        from batch import run_adaptive
+        data = run_adaptive(param_set, max_steps=steps, target_width=args.target_width, max_iterations=args.max_iterations,
+                            processes=args.processes, seed=seed, cache=cache)
+    elif args.mode == 'queue':
+        # execute batch run through a work queue on disk, that other hosts can join and that survives crashes
+        from workqueue import run_queued
+        data = run_queued(param_set, iterations=iterations, max_steps=steps, path=args.queue, processes=args.processes, seed=seed)
+    else:
+        # execute batch run, spread over all cores, reusing the runs that are already in the cache
+        from batch import run_scenarios
+        data = run_scenarios(param_set, iterations=iterations, max_steps=steps, processes=args.processes, seed=seed, cache=cache)
+
+    # convert to dataframe
+    import pandas as pd
+    l = list(data.values())
+    k = list(data.keys())
+
+    df = pd.concat(l, keys=k, axis=0).reset_index(level=1)
+    print(df)
+    if args.save:
+        if args.save.endswith('.csv'):
+            df.to_csv(args.save)
         else:
-            policy = 0
-
-        # define the base case and variable names that will be varied
-        variable_names = ['name', 'drinks_for_cup', 'reluctance_avg', 'awareness', 'stands'] # these vars will be varied
-        base_case = ['Base case', policy, 0.5, 0.05, ((2, 5), (8, 7), (12, 12))] # these are the default values
-        base_case_dict = dict(zip(variable_names, base_case))
-
-        # define the six variations to the base case
-        varied_values = [{'reluctance_avg': 0.2},
-                      {'reluctance_avg': 0.8},
-                      {'awareness': 0.02},
-                      {'awareness': 0.08},
-                      {'stands': ((2, 5), ( 8, 7))},
-                      {'stands': ((2, 5), (3, 4), (8, 7), (12, 12))}]
-
-        # name the six variations
-        scenario_names = ['Variation ' + str(n) for n in range(1, 7)]
-        for d, name in zip(varied_values, scenario_names):
-            d['name'] = name
-
-        # copy the base case dict six times into the list of dicts that will be used for the batchrunner
-        param_set = [base_case_dict.copy() for i in range(6)] # Copying is necessary to make the dicts unique objects
-
-        # insert the varied values into corresponding dicts
-        for d, to_insert in zip(param_set, varied_values):
-            for key, value in to_insert.items():
-                d[key] = value
-
-        # insert the base case
-        param_set.insert(0, base_case_dict)
-
-        # execute batch run
-        all_scenarios = FixedBatchRunner(Festival, parameters_list=param_set, iterations=batch_size, display_progress=True, max_steps=steps)
-        all_scenarios.run_all()
-        data = all_scenarios.get_collector_model()
-
-        # convert to dataframe
-        new_keys = ['Base case'] + scenario_names
-        new_data = dict()
-
-        for key, new_key in zip(data.keys(), new_keys):
-            new_data[new_key] = data[key]
-
-        l = list(new_data.values())
-        k = list(new_data.keys())
-        print(str(l))
-
-        df = pd.concat(l, keys=k, axis=0).reset_index(level=1)
-        print(df)
-        visualize_batch(df, steps)
\ No newline at end of file
+            df.to_pickle(args.save)
+    if args.plot:
+        from visualize import visualize_batch
+        visualize_batch(df, steps)
+
+
+def plot(args, config):
+    import os
+    import pandas as pd
+    from visualize import visualize_batch
+
+    if os.path.isdir(args.source):
+        from store import ResultStore
+        store = ResultStore(args.source)
+        scenario = store.scenarios()[0]
+        first = store.iterations(scenario)[0]
+        if args.steps:
+            steps = args.steps
+        elif 'Step' in store.meta(scenario, first)['columns']: # downsampled, the last row is the last step
+            steps = int(store.column(scenario, first, 'Step')[-1]) + 1
+        else:
+            steps = store.meta(scenario, first)['steps']
+        visualize_batch(store, steps)
+        return
+
+    if args.source.endswith('.csv'):
+        df = pd.read_csv(args.source, index_col=0)
+    else:
+        df = pd.read_pickle(args.source)
+    visualize_batch(df, args.steps or int(df['Step'].max()) + 1)
+
+
+def parse_args(argv=None):
+    # options that can be given before or after the command
+    common = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    common.add_argument('--config', help="TOML or JSON file with the scenarios")
+    common.add_argument('--no-policy', dest='policy', action='store_false', help="run without policy, a cup is worth no drinks")
+    common.add_argument('--seed', type=int, help="seed of the run or batch")
+
+    parser = argparse.ArgumentParser(description="Festival cup recycling model", parents=[common])
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help="run one scenario", parents=[common])
+    run_parser.add_argument('--scenario', default='Base case', help="name of the scenario in the config")
+    run_parser.add_argument('--steps', type=int, help="number of steps, defaults to the config")
+    run_parser.add_argument('--engine', choices=['agents', 'vectorized'], default='agents')
+    run_parser.add_argument('--plot', action='store_true', help="show and save the grid and the cup counters")
+    run_parser.add_argument('--replay', metavar='FILE', help="render a replay of the run to a GIF or MP4 file")
+    run_parser.add_argument('--profile', action='store_true', help="print the time spent per phase of the step")
+    run_parser.add_argument('--hotspots', action='store_true', help="save heatmaps of drops, pickups, cups on the floor and traffic per cell")
+
+    batch_parser = commands.add_parser('batch', help="run every scenario a number of iterations", parents=[common])
+    batch_parser.add_argument('--mode', choices=['memory', 'store', 'aggregate', 'adaptive', 'paired', 'queue', 'hotspots'], default='memory',
+                              help="keep the runs in memory, stream them to a result store, only keep running statistics, "
+                                   "run every scenario until its percentage lost is known precisely enough, "
+                                   "compare every scenario with the base case on common random numbers, "
+                                   "hand the runs out through a work queue that workers on other hosts can join, "
+                                   "or count drops, pickups, cups on the floor and traffic per cell")
+    batch_parser.add_argument('--iterations', type=int, help="runs per scenario, defaults to the config")
+    batch_parser.add_argument('--steps', type=int, help="steps per run, defaults to the config")
+    batch_parser.add_argument('--processes', type=int, help="number of worker processes, defaults to the number of cores")
+    batch_parser.add_argument('--cache', default='.cache', help="directory of the result cache, empty to disable it")
+    batch_parser.add_argument('--store', default='results', help="directory of the result store, for --mode store")
+    batch_parser.add_argument('--queue', default='queue.db', help="SQLite file of the work queue, for --mode queue")
+    batch_parser.add_argument('--target-width', type=float, default=2.0, help="confidence interval width in percentage points, for --mode adaptive")
+    batch_parser.add_argument('--max-iterations', type=int, default=50, help="runs per scenario at most, for --mode adaptive")
+    batch_parser.add_argument('--antithetic', action='store_true', help="pair every run with a run on mirrored random numbers, for --mode paired")
+    batch_parser.add_argument('--save', metavar='FILE', help="save the results to a pickle or CSV file, to plot later")
+    batch_parser.add_argument('--no-plot', dest='plot', action='store_false', help="do not plot the results")
+
+    plot_parser = commands.add_parser('plot', help="plot saved batch results")
+    plot_parser.add_argument('source', help="file saved with batch --save, or the directory of a result store")
+    plot_parser.add_argument('--steps', type=int, help="number of steps of the runs, defaults to the length of the runs")
+
+    args = parser.parse_args(argv)
+    if args.command is None: # the batch experiment, as before there were commands
+        args = parser.parse_args([*(sys.argv[1:] if argv is None else argv), 'batch'])
+    # defaults of the common options, not set on the parser since its actions are shared with the commands
+    for name, value in (('config', str(Path(__file__).with_name('scenarios.toml'))), ('policy', True), ('seed', None)):
+        if not hasattr(args, name):
+            setattr(args, name, value)
+    return args
+
+
+# Run (shift + F10)
+if __name__ == '__main__':
+    args = parse_args()
+    config = load_config(args.config) if args.command != 'plot' else {}
+    {'run': run, 'batch': batch, 'plot': plot}[args.command](args, config)
@@ -1,27 +1,33 @@
+import random
+import numpy as np
 from mesa import Model
-from mesa.space import MultiGrid
-from mesa.time import RandomActivation
-from agents import Visitor, Stand, Cup
-from mesa.datacollection import DataCollector
+from agents import Visitor, Stand, Cup, CupPool
+from collector import ModelCollector
+from events import EventLog, SILENT, VERBOSE
+from hotspots import CellAccumulators
+from profiling import Profiler
+from scheduler import TypedActivation
+from streams import STREAMS, substreams
+from replay import ReplayRecorder
+from space import FestivalGrid
+from vectorized import VisitorArrays
 
 
 def get_cup_on_floor(model):
     '''Return the number of cups on the floor'''
 
     count = 0
-    for g in model.schedule.agents:
-        if isinstance(g, Cup):
-            if g.on_floor == True:
-                count += 1
+    for g in model.cups:
+        if g.on_floor == True:
+            count += 1
     return count
 
 def get_reuse_count(model):
     '''Return total amount of times that cups have been reused'''
 
     count = 0
-    for g in model.schedule.agents:
-        if isinstance(g, Cup):
-            count += g.reuse_count
+    for g in model.cups:
+        count += g.reuse_count
 
     return count
 
@@ -29,11 +35,7 @@ def get_reuse_count(model):
 def get_cup(model):
     '''Return total number of cups in the model'''
 
-    count = 0
-    for g in model.schedule.agents:
-        if isinstance(g,Cup):
-            count += 1
-    return count
+    return len(model.cups)
 
 
 
@@ -41,52 +43,66 @@ class Festival (Model):
     """A model that represents a festival terrain, in which Visitor agents move around and interact with Stands and Cups.
     The model is designed to analyze cup recycling behavior"""
 
-    def __init__(self, drinks_for_cup=1, reluctance_avg=0.5, awareness=0.05, stands=((2, 5), (8, 7), (12, 12)), visitors=200, width=15, height=15, name='Base case', verbose=False):
+    def __init__(self, drinks_for_cup=1, reluctance_avg=0.5, awareness=0.05, stands=((2, 5), (8, 7), (12, 12)), visitors=200, width=15, height=15, name='Base case', verbose=False, log=None, debug=False, engine="agents", seed=None, profile=False, replay=False, recording=None, crn=False, antithetic=False, hotspots=False):
         super().__init__()
+        self.random = random.Random(seed) # per model, mesa keeps the generator on the class
+
+        # with common random numbers every purpose draws from its own stream, so runs with the same seed and
+        # different parameters stay in step; otherwise all streams are the same generator
+        self.crn = crn or antithetic
+        self.antithetic = antithetic
+        streams = substreams(seed, antithetic) if self.crn else dict.fromkeys(STREAMS, self.random)
+        self.rng_init, self.rng_order, self.rng_move, self.rng_decide, self.rng_dirt = (streams[name] for name in STREAMS)
         self.name = name
         self.verbose = verbose
+        self.log = log if log is not None else EventLog(VERBOSE if verbose else SILENT) # cup events
+        self.debug = debug # check the cup counters against a full scan of the agents every step
+        if engine not in ("agents", "vectorized"):
+            raise ValueError("engine must be 'agents' or 'vectorized', not " + repr(engine))
+        self.engine = engine
         self.num_visitors = visitors
         self.pos_stands = stands
-        self.schedule = RandomActivation(self)
-        self.grid = MultiGrid(height, width, True)
+        self.schedule = TypedActivation(self, active=[Visitor], shuffled=[Visitor], random=self.rng_order) # stands have nothing to do
+        self.cups = CupPool(self) # cups are not scheduled
+        self.grid = FestivalGrid(height, width, True)
+
+        # per cell counts of drops, pickups, cups on the floor and traffic, for hotspot analysis
+        self.hotspots = CellAccumulators(self.grid.width, self.grid.height) if hotspots else None
+        self.grid.hotspots = self.hotspots
+        self.stands = []
+        self.stand_index = None # nearest stand per cell, built on first lookup
         self.cups_returned = 0
         self.cup_id = 0
-        self.cups_on_floor = 0
         self.drinks_for_cup = drinks_for_cup
         self.awareness = awareness
         self.reluctance_avg = reluctance_avg
 
+        # cup counters, updated by the agents at every cup event
         self.cups_on_floor = 0
-        self.datacollector = DataCollector({"Lost cups": lambda m: get_cup_on_floor(self),
-                                            "Total cups": lambda m: get_cup(self),
-                                            "Reuse count": lambda m: get_reuse_count(self),
-                                            # "% lost": lambda m: round(get_cup_on_floor(self) / (get_cup(self) + get_reuse_count(self)), 2) * 100
-                                            })
-
-        # Create agents
-        for i in range(self.num_visitors):
+        self.cup_count = 0
+        self.reuse_count = 0
+
+        # recording: optional dict of ModelCollector options to bound the memory of long runs, e.g. {'every': 60, 'aggregate': 'mean'}
+        self.datacollector = ModelCollector({"Lost cups": "cups_on_floor",
+                                             "Total cups": "cup_count",
+                                             "Reuse count": "reuse_count",
+                                             # "% lost": lambda m: round(get_cup_on_floor(self) / (get_cup(self) + get_reuse_count(self)), 2) * 100
+                                             }, **(recording or {}))
+
+        # Create agents, the vectorized engine creates its visitors after the stands are placed
+        for i in range(self.num_visitors if engine == "agents" else 0):
             name = "v"+str(i)
-            reluctance = round(max(self.random.normalvariate(self.reluctance_avg, 0.5), 0), 1) # how many drinks in return for a cup would result in this agent returning the cup
-            thirst_rate = int(max(self.random.normalvariate(10, 1), 0)) # integer in range [0,100] representing how much thirstier Visitor becomes each timestep
-            sip_size = int(max(self.random.normalvariate(30, 10), 0)) # integer in range [0,200] representing how much ml is consumed each sip
-            a = Visitor(name, self, reluctance, thirst_rate, sip_size)
+            reluctance = round(max(self.rng_init.normalvariate(self.reluctance_avg, 0.5), 0), 1) # how many drinks in return for a cup would result in this agent returning the cup
+            thirst_rate = int(max(self.rng_init.normalvariate(10, 1), 0)) # integer in range [0,100] representing how much thirstier Visitor becomes each timestep
+            sip_size = int(max(self.rng_init.normalvariate(30, 10), 0)) # integer in range [0,200] representing how much ml is consumed each sip
+            a = Visitor(name, self, reluctance, thirst_rate, sip_size, i)
             self.schedule.add(a)
 
             #Add the agent to a random grid cell
-            x = self.random.randrange(self.grid.width)
-            y = self.random.randrange(self.grid.height)
+            x = self.rng_init.randrange(self.grid.width)
+            y = self.rng_init.randrange(self.grid.height)
             self.grid.place_agent(a, (x, y))
 
-        def place_stand(pos, name, model):
-            '''
-            Place a single stand at indicated coordinate
-            '''
-
-            print("placing stand "+str(name)+" at "+str(pos))
-            a = Stand(name, pos, model)
-            model.schedule.add(a)
-            model.grid.place_agent(a, pos)
-
         def place_stands(*args, model):
             '''
             Place multiple stands at the indicated coordinates
@@ -97,16 +113,114 @@ class Festival (Model):
                 assert isinstance(arg, tuple)
                 assert arg not in existing # not on top of existing stand
                 name = "s"+str(len(existing) + 1) # generate id from amount of existing stands
-                place_stand(arg, name, model)
+                model.place_stand(arg, name)
                 existing.append(arg) # keep track of existing stands
 
         place_stands(*self.pos_stands, model=self)
 
+        if engine == "vectorized":
+            self.visitors = VisitorArrays(self)
+
+        # time the phases of the step and the agent methods, profile=True or the sample rate of the agent methods
+        self.profiler = None
+        if profile:
+            self.profiler = Profiler() if profile is True else Profiler(profile)
+            self.profiler.attach(self)
+
+        # record a frame of the terrain every step, to render a replay afterwards
+        self.replay = ReplayRecorder(self) if replay else None
+
+    def reseed(self, seed):
+        """Reseed the random generators, e.g. of a fork"""
+
+        self.random.seed(seed)
+        if self.crn:
+            for name, stream in substreams(seed, self.antithetic).items():
+                getattr(self, 'rng_' + name).setstate(stream.getstate())
+        if self.engine == "vectorized":
+            self.visitors.rng = np.random.default_rng(seed)
+
+    def place_stand(self, pos, name):
+        '''
+        Place a single stand at indicated coordinate
+        '''
+
+        if self.log.level >= VERBOSE:
+            print("placing stand "+str(name)+" at "+str(pos))
+        a = Stand(name, pos, self)
+        self.schedule.add(a)
+        self.grid.place_agent(a, pos)
+        self.stands.append(a)
+        self.stand_index = None # rebuild on next lookup
+
+    def remove_stand(self, stand):
+        '''
+        Remove a stand from the terrain
+        '''
+
+        self.schedule.remove(stand)
+        self.grid.remove_agent(stand)
+        self.stands.remove(stand)
+        self.stand_index = None # rebuild on next lookup
+
+    def build_stand_index(self):
+        '''
+        Compute the nearest stand for every cell of the grid. Distances wrap around the edges of the torus,
+        ties go to the stand that was placed first.
+        '''
+
+        self.stand_pos = np.array([stand.pos for stand in self.stands]).reshape(-1, 2)
+        x = np.arange(self.grid.width)[:, None, None]
+        y = np.arange(self.grid.height)[None, :, None]
+        dx = np.abs(x - self.stand_pos[:, 0])
+        dy = np.abs(y - self.stand_pos[:, 1])
+        dx = np.minimum(dx, self.grid.width - dx)
+        dy = np.minimum(dy, self.grid.height - dy)
+        self.stand_index = np.argmin(dx ** 2 + dy ** 2, axis=2)
+
+    def nearest_stand(self, pos):
+        '''
+        Return the Stand nearest to a position
+        '''
+
+        if self.stand_index is None:
+            self.build_stand_index()
+        return self.stands[self.stand_index[pos]]
+
+    def check_counters(self):
+        """Compare the cup counters with a full scan of the agents"""
+
+        if self.engine == "vectorized":
+            assert self.cups_on_floor == self.visitors.n_floor, "Lost cups counter out of sync"
+            return
+
+        assert self.cups_on_floor == get_cup_on_floor(self), "Lost cups counter out of sync"
+        assert self.cups_on_floor == self.grid.floor_cups.sum(), "Floor cups of the grid out of sync"
+        clean = sum(1 for cell in self.grid.coord_iter() for a in cell[0] if isinstance(a, Cup) and a.dirty < 0.7)
+        assert clean == self.grid.clean_cups.sum(), "Clean cups of the grid out of sync"
+        assert self.cup_count == get_cup(self), "Total cups counter out of sync"
+        assert self.reuse_count == get_reuse_count(self), "Reuse count counter out of sync"
+
+    def profile_report(self):
+        """Return a DataFrame with the time spent per phase of the step and per agent method, for a model created with profile=True"""
+
+        if self.profiler is None:
+            raise RuntimeError("profiling is off, create the Festival with profile=True")
+        return self.profiler.report()
 
     def step(self):
         """Advance the model by one step and collect data"""
 
+        if self.engine == "vectorized":
+            self.visitors.step()
         self.schedule.step()
+        self.cups.step() # soil the cups on the floor up to the new time
+        if self.hotspots is not None:
+            self.hotspots.step(self.visitors.counts() if self.engine == "vectorized" else self.grid.floor_cups)
+        if self.debug:
+            self.check_counters()
+        if self.replay is not None:
+            self.replay.capture()
 
         # collect data
         self.datacollector.collect(self)
@@ -0,0 +1,163 @@
+import random
+
+from aggregate import RunningStats, lost_ratio
+from batch import iter_runs
+
+
+def layout_name(stands):
+    return 'stands ' + ' '.join(str(x) + ',' + str(y) for x, y in stands)
+
+
+def normalize(stands):
+    '''Return a layout as a sorted tuple of unique positions, so the same layout is evaluated once'''
+
+    return tuple(sorted(set(tuple(int(c) for c in pos) for pos in stands)))
+
+
+class StandOptimizer:
+    '''
+    Search for stand layouts that minimise the percentage of cups lost per cup used, with an evolutionary
+    (mu + lambda) search: every generation the best layouts are mutated by moving, adding or removing
+    stands, and the children are evaluated in parallel.
+
+    Every layout is run with the same seeds (common random numbers), so differences between layouts are
+    not buried in the noise of different visitors. Evaluations are kept per layout, and with a ResultCache
+    repeated searches reuse the runs on disk.
+    '''
+
+    def __init__(self, base=None, n_stands=(2, 5), iterations=5, max_steps=100, processes=None, seed=0, cache=None):
+        '''
+        Creates a new optimizer
+
+        Args:
+            base: dict of Festival parameters of the terrain, e.g. width, height and visitors
+            n_stands: smallest and largest number of stands in a layout
+            iterations: runs per layout
+            max_steps: steps per run, shorter than a full run to evaluate more layouts
+            processes: number of worker processes, defaults to the number of cores
+            seed: seed of the search and of the runs
+            cache: optional ResultCache
+        '''
+
+        self.base = dict(base or {})
+        self.base.pop('stands', None)
+        self.width = self.base.get('width', 15)
+        self.height = self.base.get('height', 15)
+        self.n_stands = n_stands
+        self.iterations = iterations
+        self.max_steps = max_steps
+        self.processes = processes
+        self.seed = seed
+        self.cache = cache
+        self.random = random.Random(seed)
+        self.results = {} # layout -> RunningStats of the end-of-run percentage lost
+
+    def params(self, stands):
+        return dict(self.base, name=layout_name(stands), stands=stands)
+
+    def evaluate(self, layouts):
+        '''Run the layouts that have not been evaluated yet, all in one batch'''
+
+        layouts = [stands for stands in dict.fromkeys(layouts) if stands not in self.results]
+        if not layouts:
+            return
+        by_name = {layout_name(stands): stands for stands in layouts}
+        for stands in layouts:
+            self.results[stands] = RunningStats(1)
+
+        runs = iter_runs([self.params(stands) for stands in layouts], self.iterations, self.max_steps, self.processes,
+                         self.seed, display_progress=False, cache=self.cache, common_random_numbers=True)
+        for name, iteration, data in runs:
+            end = data.iloc[-1]
+            self.results[by_name[name]].update(lost_ratio(end['Lost cups'], end['Total cups'], end['Reuse count']) * 100)
+
+    def score(self, stands):
+        return self.results[stands].mean[0]
+
+    def random_layout(self):
+        n = self.random.randint(*self.n_stands)
+        cells = self.random.sample(range(self.width * self.height), n)
+        return normalize((cell % self.width, cell // self.width) for cell in cells)
+
+    def mutate(self, stands, distance=2):
+        '''Return a copy of a layout with one stand moved, added or removed'''
+
+        stands = list(stands)
+        moves = ['move']
+        if len(stands) < self.n_stands[1]:
+            moves.append('add')
+        if len(stands) > self.n_stands[0]:
+            moves.append('remove')
+        move = self.random.choice(moves)
+
+        if move == 'add':
+            stands.append((self.random.randrange(self.width), self.random.randrange(self.height)))
+        elif move == 'remove':
+            stands.pop(self.random.randrange(len(stands)))
+        else:
+            i = self.random.randrange(len(stands))
+            x, y = stands[i]
+            stands[i] = ((x + self.random.randint(-distance, distance)) % self.width,
+                         (y + self.random.randint(-distance, distance)) % self.height)
+
+        stands = normalize(stands)
+        if not self.n_stands[0] <= len(stands) <= self.n_stands[1]: # a stand moved onto another one
+            return self.mutate(stands, distance)
+        return stands
+
+    def run(self, generations=20, parents=4, children=8, start=(), display_progress=True):
+        '''
+        Run the search
+
+        Args:
+            generations: number of generations
+            parents: number of best layouts that are kept every generation
+            children: number of mutated layouts evaluated every generation
+            start: layouts to start from, e.g. the stands of the base case, filled up with random layouts
+
+        Returns:
+            DataFrame of the evaluated layouts, best first, as returned by report
+        '''
+
+        population = [normalize(stands) for stands in start]
+        population += [self.random_layout() for i in range(max(parents + children - len(population), 0))]
+        self.evaluate(population)
+
+        for generation in range(generations):
+            best = sorted(self.results, key=self.score)[:parents]
+            offspring = [self.mutate(self.random.choice(best)) for i in range(children)]
+            self.evaluate(offspring)
+            if display_progress:
+                print("generation", generation + 1, "best", layout_name(best[0]), "lost", round(self.score(best[0]), 2), "%")
+
+        return self.report()
+
+    def report(self, top=None, confidence=0.95):
+        '''Return a DataFrame with the percentage lost of the evaluated layouts, best first'''
+
+        import pandas as pd
+
+        rows = []
+        for stands, stats in self.results.items():
+            low, high = stats.interval(confidence)
+            rows.append({'stands': stands, 'count': len(stands), 'percentage lost': stats.mean[0],
+                         'std': stats.std[0], 'low': low[0], 'high': high[0], 'iterations': stats.n})
+        report = pd.DataFrame(rows).sort_values('percentage lost').reset_index(drop=True)
+        return report.head(top) if top is not None else report
+
+
+def optimize_stands(base=None, n_stands=(2, 5), generations=20, iterations=5, max_steps=100, start=(), top=5, processes=None, seed=0, cache=None):
+    '''
+    Search for the stand layouts with the fewest lost cups on a terrain, and return the best ones with their
+    percentage lost per cup used, see StandOptimizer
+    '''
+
+    optimizer = StandOptimizer(base, n_stands, iterations, max_steps, processes, seed, cache)
+    return optimizer.run(generations, start=start).head(top)
+
+
+if __name__ == '__main__':
+    from cache import ResultCache
+
+    best = optimize_stands(start=[((2, 5), (8, 7), (12, 12))], cache=ResultCache())
+    print(best.to_string())
@@ -0,0 +1,126 @@
+import time
+
+from agents import Visitor
+
+
+# methods that are timed, per component of the model
+VISITOR_METHODS = ('step', 'get_drink', 'find_stand', 'random_move', 'move_towards', 'drop_cup', 'collect_cup', 'buy_drink')
+ARRAY_METHODS = ('soil_cups', 'move', 'nearest_stand', 'random_move', 'move_towards', 'buy_drink', 'drop_cup', 'collect_cup', 'get_thirstier')
+GRID_METHODS = ('move_agent', 'get_neighborhood', 'trash_around', 'clean_around', 'drop_cup', 'pick_up_cup')
+CUP_METHODS = ('create', 'dropped')
+
+
+class Profiler:
+    '''
+    Cumulative wall time and call counts of the phases of Festival.step and the methods of its agents.
+
+    The profiler wraps the methods of a single model as instance attributes, so a model without a profiler
+    runs the plain methods and pays nothing. Phases of the step are timed on every call. Agent methods are
+    only timed for one in sample visitors, each of which times a single method so the timers do not nest,
+    and grid methods on one in sample calls; their calls and total time are estimated from those. Times
+    are inclusive: Visitor.step contains the find_stand and random_move calls it makes.
+    '''
+
+    def __init__(self, sample=10):
+        '''
+        Creates a new profiler
+
+        Args:
+            sample: time the methods of one in this many visitors, and one in this many calls of the grid
+        '''
+
+        self.sample = sample
+        self.timings = {} # name -> [calls, timed calls, seconds of the timed calls]
+        self.scale = {} # name -> factor from the calls seen to all calls, for methods of sampled visitors
+        self.patched = [] # (object, attribute) of the wrapped methods
+
+    def wrap(self, name, func, sample=1):
+        '''Return func wrapped to count its calls and time one in sample calls under name'''
+
+        entry = self.timings.setdefault(name, [0, 0, 0.0])
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            entry[0] += 1
+            if entry[0] % sample:
+                return func(*args, **kwargs)
+            entry[1] += 1
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                entry[2] += clock() - start
+
+        return timed
+
+    def patch(self, obj, attribute, name, sample=1):
+        '''Replace a method of a single object by its timed version'''
+
+        setattr(obj, attribute, self.wrap(name, getattr(obj, attribute), sample))
+        self.patched.append((obj, attribute))
+
+    def attach(self, model):
+        '''Wrap the phases of the step and the agent methods of a Festival'''
+
+        self.patch(model, 'step', 'Festival.step')
+        self.patch(model.schedule, 'step', 'schedule.step')
+        self.patch(model.schedule.random, 'shuffle', 'schedule shuffle')
+        self.patch(model.cups, 'step', 'CupPool.step')
+        self.patch(model.datacollector, 'collect', 'DataCollector.collect')
+        for method in CUP_METHODS:
+            self.patch(model.cups, method, 'CupPool.' + method, self.sample)
+        for method in GRID_METHODS:
+            self.patch(model.grid, method, 'FestivalGrid.' + method, self.sample)
+
+        if model.engine == "vectorized":
+            self.patch(model.visitors, 'step', 'VisitorArrays.step')
+            for method in ARRAY_METHODS:
+                self.patch(model.visitors, method, 'VisitorArrays.' + method)
+        else:
+            visitors = model.schedule.agents_of(Visitor)
+            timed = visitors[::self.sample]
+            for i, method in enumerate(VISITOR_METHODS):
+                for agent in timed[i::len(VISITOR_METHODS)]:
+                    self.patch(agent, method, 'Visitor.' + method)
+                self.scale['Visitor.' + method] = len(visitors) / max(len(timed[i::len(VISITOR_METHODS)]), 1)
+
+    def detach(self):
+        '''Restore the plain methods, e.g. before a model is pickled'''
+
+        for obj, attribute in self.patched:
+            delattr(obj, attribute)
+        self.patched = []
+
+    def merge(self, other):
+        '''Add the timings of another profiler, e.g. of another run of a batch, to this one'''
+
+        for name, (calls, timed, seconds) in other.timings.items():
+            scale = other.scale.get(name, 1) / self.scale.get(name, 1) # runs can have different numbers of visitors
+            entry = self.timings.setdefault(name, [0, 0, 0.0])
+            entry[0] += calls * scale
+            entry[1] += timed
+            entry[2] += seconds
+
+    def __getstate__(self):
+        '''Only the timings are pickled, so a profiler can be sent back from a worker process'''
+
+        return {'sample': self.sample, 'timings': self.timings, 'scale': self.scale, 'patched': []}
+
+    def report(self):
+        '''Return a DataFrame with the calls, estimated total time and time per call of every phase and method'''
+
+        import pandas as pd
+
+        rows = {}
+        for name, (calls, timed, seconds) in self.timings.items():
+            if calls == 0:
+                continue
+            total = seconds * calls / timed if timed else float('nan')
+            calls = int(round(calls * self.scale.get(name, 1)))
+            total *= self.scale.get(name, 1)
+            rows[name] = {'calls': calls, 'timed calls': timed, 'time (s)': total, 'per call (us)': total / calls * 1e6}
+        report = pd.DataFrame.from_dict(rows, orient='index', columns=['calls', 'timed calls', 'time (s)', 'per call (us)'])
+        if 'Festival.step' in report.index:
+            report['% of step'] = report['time (s)'] / report.loc['Festival.step', 'time (s)'] * 100
+        report.index.name = 'phase'
+        return report.sort_values('time (s)', ascending=False)
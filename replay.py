@@ -0,0 +1,203 @@
+import subprocess
+
+import numpy as np
+
+from agents import Visitor
+
+
+# cell values of the occupancy frames, as in visualize_model
+EMPTY, NO_CUP, HAS_CUP, STAND = range(4)
+CONDITIONS = {"HasNoCup": NO_CUP, "HasCup": HAS_CUP}
+
+
+class ReplayRecorder:
+    '''
+    Records a compact frame of a Festival every step, for rendering a replay afterwards: the occupancy of
+    every cell (empty, visitor without cup, visitor with cup, stand) and the number of cups on the floor,
+    both as uint8 arrays indexed [x, y], plus the cup counters. Frames go into preallocated chunks, so
+    capturing a step is a few array writes and does not touch matplotlib.
+    '''
+
+    def __init__(self, model, chunk=1024):
+        '''
+        Creates a new recorder and captures the current state of the model as the first frame
+
+        Args:
+            model: the Festival to record
+            chunk: number of frames allocated at a time
+        '''
+
+        self.model = model
+        self.chunk = chunk
+        self.shape = (model.grid.width, model.grid.height)
+        self.stands = np.array([stand.pos for stand in model.stands], dtype=np.int64).reshape(-1, 2)
+        self.visitors = model.schedule.agents_of(Visitor)
+        self.occupancy_chunks = []
+        self.floor_chunks = []
+        self.counter_chunks = []
+        self.size = 0 # number of frames
+        self.capture()
+
+    def capture(self):
+        '''Record the current state of the model as the next frame'''
+
+        i = self.size % self.chunk
+        if i == 0:
+            self.occupancy_chunks.append(np.zeros((self.chunk, *self.shape), dtype=np.uint8))
+            self.floor_chunks.append(np.zeros((self.chunk, *self.shape), dtype=np.uint8))
+            self.counter_chunks.append(np.zeros((self.chunk, 3), dtype=np.int64))
+        occupancy = self.occupancy_chunks[-1][i]
+        model = self.model
+
+        if model.engine == "vectorized":
+            visitors = model.visitors
+            occupancy[visitors.x, visitors.y] = visitors.conditions()
+            floor = np.zeros(self.shape, dtype=np.int64)
+            np.add.at(floor, (visitors.floor_x[:visitors.n_floor], visitors.floor_y[:visitors.n_floor]), 1)
+        else:
+            for a in self.visitors:
+                occupancy[a.pos] = CONDITIONS[a.condition]
+            floor = model.grid.floor_cups
+        occupancy[self.stands[:, 0], self.stands[:, 1]] = STAND
+
+        np.minimum(floor, 255, out=self.floor_chunks[-1][i], casting='unsafe')
+        self.counter_chunks[-1][i] = (model.cups_on_floor, model.cup_count, model.reuse_count)
+        self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def frames(self):
+        '''Return the occupancy frames, floor cup frames and counters (Lost cups, Total cups, Reuse count) as arrays'''
+
+        def join(chunks):
+            return np.concatenate(chunks)[:self.size] if chunks else np.zeros((0, *self.shape), dtype=np.uint8)
+
+        return join(self.occupancy_chunks), join(self.floor_chunks), join(self.counter_chunks)
+
+    def save(self, path):
+        '''Write the frames to a compressed .npz file'''
+
+        occupancy, floor, counters = self.frames()
+        np.savez_compressed(path, occupancy=occupancy, floor=floor, counters=counters)
+
+
+def load_frames(path):
+    '''Return the occupancy frames, floor cup frames and counters of a replay saved by ReplayRecorder.save'''
+
+    with np.load(path) as data:
+        return data['occupancy'], data['floor'], data['counters']
+
+
+def render_replay(replay, path, fps=30, every=1, dpi=80, title=""):
+    '''
+    Render a replay to an MP4 (with ffmpeg) or GIF file. The figure with its axes, colorbars and the full
+    line plot of the cup counters is drawn once with matplotlib. Every frame then only writes the two
+    grids into their axes of a copy of that picture and moves a cursor over the line plot, so a long
+    replay renders in seconds. GIFs keep all frames in memory, use every or MP4 for long replays.
+
+    Args:
+        replay: a ReplayRecorder, or the path of a replay saved with ReplayRecorder.save
+        path: output file, the extension picks the format
+        fps: frames per second of the output
+        every: render one in every this many steps
+    '''
+
+    import matplotlib
+    matplotlib.use('Agg') # headless
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.colors import ListedColormap
+    from matplotlib.figure import Figure
+    from PIL import Image
+
+    if isinstance(replay, ReplayRecorder):
+        occupancy, floor, counters = replay.frames()
+    else:
+        occupancy, floor, counters = load_frames(replay)
+    steps = np.arange(len(occupancy))[::every]
+
+    # draw everything that does not change once
+    fig = Figure(figsize=(15, 5), dpi=dpi, facecolor=(1, 1, 1))
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.subplots(1, 3)
+    grid = ax[0].imshow(occupancy[0], cmap=ListedColormap(['grey', 'green', 'red', 'blue']), vmin=-0.5, vmax=3.5)
+    colorbar = fig.colorbar(grid, ax=ax[0], ticks=[0, 1, 2, 3])
+    colorbar.set_ticklabels(['Empty cell', 'Visitor without cup', 'Visitor with cup', 'Stand'])
+    ax[0].set_title("Visitors")
+    cups = ax[1].imshow(floor[0], cmap='Oranges', vmin=0, vmax=max(int(floor.max()), 1))
+    fig.colorbar(cups, ax=ax[1])
+    ax[1].set_title("Cups on the floor")
+    for values, label in zip(counters.T, ("Lost cups", "Total cups", "Reuse count")):
+        ax[2].plot(values, label=label)
+    ax[2].set_xlabel("Steps")
+    ax[2].set_ylabel("Cups")
+    ax[2].legend(loc='upper left')
+    fig.suptitle(title)
+    fig.tight_layout()
+    grid.set_visible(False)
+    cups.set_visible(False)
+    canvas.draw()
+    background = np.asarray(canvas.buffer_rgba())[..., :3].copy()
+    height, width = background.shape[:2]
+
+    def pixels(axes):
+        '''Return the rows and columns of the picture covered by axes'''
+
+        box = axes.get_window_extent()
+        return slice(height - int(round(box.y1)), height - int(round(box.y0))), slice(int(round(box.x0)), int(round(box.x1)))
+
+    # the picture is composed as indices into one palette of at most 256 colors: the background quantized,
+    # followed by the colors of the cells of both grids and the cursor
+    vmax = max(int(floor.max()), 1)
+    levels = min(vmax + 1, 64)
+    occupancy_colors = grid.cmap(grid.norm(np.arange(4)))
+    floor_colors = cups.cmap(cups.norm(np.arange(levels) * vmax / (levels - 1)))
+    quantized = Image.fromarray(background).quantize(colors=256 - 4 - levels - 1, dither=Image.Dither.NONE)
+    n = len(quantized.getpalette()) // 3
+    palette = np.concatenate([np.array(quantized.getpalette(), dtype=np.uint8).reshape(-1, 3),
+                              (np.concatenate([occupancy_colors, floor_colors])[:, :3] * 255).astype(np.uint8),
+                              np.zeros((1, 3), dtype=np.uint8)])
+    background = np.asarray(quantized).copy()
+    black = len(palette) - 1
+
+    # per image axes: its pixels, the cell shown at every pixel, and the palette index of every cell value
+    values = np.arange(256)
+    lookups = (n + np.minimum(values, 3), n + 4 + np.minimum(values * (levels - 1) // vmax, levels - 1))
+    images = []
+    for axes, lookup in zip((ax[0], ax[1]), lookups):
+        rows, columns = pixels(axes)
+        cell_rows = ((np.arange(rows.stop - rows.start) + 0.5) / (rows.stop - rows.start) * occupancy.shape[1]).astype(int)
+        cell_columns = ((np.arange(columns.stop - columns.start) + 0.5) / (columns.stop - columns.start) * occupancy.shape[2]).astype(int)
+        images.append((rows, columns, cell_rows[:, None], cell_columns[None, :], lookup.astype(np.uint8)))
+    line_rows, line_columns = pixels(ax[2])
+    left, right = ax[2].get_xlim()
+
+    def frames():
+        for t in steps:
+            picture = background.copy()
+            for (rows, columns, cell_rows, cell_columns, lookup), cells in zip(images, (occupancy[t], floor[t])):
+                picture[rows, columns] = lookup[cells[cell_rows, cell_columns]]
+            cursor = line_columns.start + int((t - left) / (right - left) * (line_columns.stop - line_columns.start))
+            picture[line_rows, cursor:cursor + 2] = black
+            yield picture
+
+    if str(path).endswith('.gif'):
+        def pictures():
+            for picture in frames():
+                image = Image.fromarray(picture, 'P')
+                image.putpalette(palette.tobytes())
+                yield image
+
+        pictures = pictures()
+        first = next(pictures)
+        first.save(path, save_all=True, append_images=pictures, duration=int(1000 / fps), loop=0, optimize=False)
+    else:
+        command = [matplotlib.rcParams['animation.ffmpeg_path'], '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', str(width) + 'x' + str(height), '-r', str(fps), '-i', '-',
+                   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', str(path)]
+        with subprocess.Popen(command, stdin=subprocess.PIPE) as ffmpeg:
+            for picture in frames():
+                ffmpeg.stdin.write(palette[picture].tobytes())
+            ffmpeg.stdin.close()
+        if ffmpeg.returncode:
+            raise RuntimeError("ffmpeg failed with exit code " + str(ffmpeg.returncode))
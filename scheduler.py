@@ -0,0 +1,57 @@
+from mesa.time import BaseScheduler
+
+
+class TypedActivation(BaseScheduler):
+    '''
+    Scheduler that keeps a separate activation group per agent type. Every step the groups of the active
+    types are stepped one after the other, each in random order if it is shuffled, the same way
+    RandomActivation shuffles all agents. Agents of other types, like Stands, are kept in the schedule
+    but never stepped or shuffled. Adding and removing an agent is O(1).
+    '''
+
+    def __init__(self, model, active=(), shuffled=(), random=None):
+        '''
+        Creates a new scheduler
+
+        Args:
+            model: the model
+            active: the agent types that are stepped, in this order
+            shuffled: the active types that are stepped in random order
+            random: generator used for the shuffles, defaults to model.random
+        '''
+
+        super().__init__(model)
+        self.active = tuple(active)
+        self.shuffled = frozenset(shuffled)
+        self.random = random if random is not None else model.random
+        self.groups = {} # agent type -> {unique_id: agent}, in order of adding
+
+    def add(self, agent):
+        super().add(agent)
+        self.groups.setdefault(type(agent), {})[agent.unique_id] = agent
+
+    def remove(self, agent):
+        super().remove(agent)
+        del self.groups[type(agent)][agent.unique_id]
+
+    def agents_of(self, kind):
+        '''Return the agents of a type'''
+
+        return list(self.groups.get(kind, {}).values())
+
+    def step(self):
+        '''Step the active groups, agents removed during the step are skipped and agents added are not stepped'''
+
+        for kind in self.active:
+            group = self.groups.get(kind)
+            if not group:
+                continue
+            keys = list(group)
+            if kind in self.shuffled:
+                self.random.shuffle(keys)
+            for key in keys:
+                agent = group.get(key)
+                if agent is not None:
+                    agent.step()
+        self.steps += 1
+        self.time += 1
@@ -0,0 +1,358 @@
+from multiprocessing import Pipe, Process
+
+import numpy as np
+
+from events import EventLog
+from vectorized import VisitorArrays, NEIGHBOR_OFFSETS
+
+
+# per visitor arrays that move along when a visitor crosses into another tile
+VISITOR_FIELDS = ('x', 'y', 'thirst', 'thirst_rate', 'sip_size', 'reluctance', 'fill', 'buying', 'collected')
+
+
+class TileModel:
+    '''
+    Stands in for the Festival inside a tile worker: the parameters, stands and cup counters that
+    VisitorArrays reads and updates
+    '''
+
+    def __init__(self, spec):
+        self.drinks_for_cup = spec['drinks_for_cup']
+        self.awareness = spec['awareness']
+        self.stand_pos = np.array(spec['stands']).reshape(-1, 2)
+        self.log = EventLog()
+        self.cups_returned = 0
+        self.cup_id = 0
+        self.cups_on_floor = 0
+        self.cup_count = 0
+        self.reuse_count = 0
+
+
+class TileVisitors(VisitorArrays):
+    '''
+    The visitors and the cups on the floor of a single rectangular tile of a sharded festival. Positions
+    are global. The counts of the cups in the ring of cells around the tile (the halo) are handed in
+    by the coordinator before every phase that looks at the surrounding cells.
+    '''
+
+    def __init__(self, spec):
+        '''
+        Creates the visitors of a tile
+
+        Args:
+            spec: dict with the tile bounds, grid size, stands, model parameters, number of visitors and seed
+        '''
+
+        self.model = TileModel(spec)
+        self.rng = np.random.default_rng(spec['seed'])
+        self.hotspots = None # not counted per tile
+        self.width, self.height = spec['width'], spec['height']
+        self.x0, self.x1 = spec['xs']
+        self.y0, self.y1 = spec['ys']
+        n = spec['visitors']
+
+        # initial attributes, drawn from the same distributions as in Festival.__init__
+        self.reluctance = np.round(np.maximum(self.rng.normal(spec['reluctance_avg'], 0.5, n), 0), 1)
+        self.thirst_rate = np.maximum(self.rng.normal(10, 1, n), 0).astype(np.int64)
+        self.sip_size = np.maximum(self.rng.normal(30, 10, n), 0).astype(np.int64)
+        self.x = self.rng.integers(self.x0, self.x1, n)
+        self.y = self.rng.integers(self.y0, self.y1, n)
+        self.thirst = np.full(n, 20, dtype=np.int64)
+        self.fill = np.full(n, -1, dtype=np.int64)
+        self.buying = np.zeros(n, dtype=bool)
+        self.collected = np.zeros(n, dtype=np.int64)
+
+        self.stand_cups = np.zeros(len(self.model.stand_pos), dtype=np.int64)
+        self.build_stand_index()
+
+        self.floor_x = np.zeros(64, dtype=np.int64)
+        self.floor_y = np.zeros(64, dtype=np.int64)
+        self.floor_dirt = np.zeros(64, dtype=np.int64)
+        self.floor_turn = np.zeros(64, dtype=np.int64) # not used, tiles collect in random order
+        self.n_floor = 0
+
+        self.halo = None # counts of the cells around the tile, with the counts of the tile itself in the middle
+
+    def build_stand_index(self):
+        '''Compute the nearest stand for every cell of the tile, with the same distance and ties as Festival.build_stand_index'''
+
+        stands = self.model.stand_pos
+        dy = np.abs(np.arange(self.y0, self.y1)[:, None] - stands[:, 1])
+        dy = np.minimum(dy, self.height - dy) ** 2
+        self.stand_index = np.zeros((self.x1 - self.x0, self.y1 - self.y0), dtype=np.int64)
+        for x in range(self.x0, self.x1):
+            dx = np.abs(x - stands[:, 0])
+            dx = np.minimum(dx, self.width - dx) ** 2
+            self.stand_index[x - self.x0] = np.argmin(dx + dy, axis=1)
+
+    def nearest_stand(self, x, y):
+        '''Return the index of the nearest stand for every given position in the tile'''
+
+        return self.stand_index[x - self.x0, y - self.y0]
+
+    def counts(self, clean_only=False):
+        '''Return the number of cups on the floor per cell of the tile'''
+
+        n = self.n_floor
+        keep = self.floor_dirt[:n] < 7 if clean_only else slice(None)
+        w, h = self.x1 - self.x0, self.y1 - self.y0
+        cells = (self.floor_x[:n][keep] - self.x0) * h + self.floor_y[:n][keep] - self.y0
+        return np.bincount(cells, minlength=w * h).reshape(w, h)
+
+    def edges(self, clean_only=False):
+        '''Return the counts of the outer rows and columns of the tile, which are in the halo of the neighboring tiles'''
+
+        counts = self.counts(clean_only)
+        return counts[0, :], counts[-1, :], counts[:, 0], counts[:, -1]
+
+    def set_halo(self, halo, clean_only=False):
+        '''Surround the counts of the tile with the halo from the neighboring tiles'''
+
+        left, right, bottom, top, corners = halo
+        counts = self.counts(clean_only)
+        padded = np.zeros((counts.shape[0] + 2, counts.shape[1] + 2), dtype=np.int64)
+        padded[1:-1, 1:-1] = counts
+        padded[0, 1:-1], padded[-1, 1:-1] = left, right
+        padded[1:-1, 0], padded[1:-1, -1] = bottom, top
+        padded[0, 0], padded[0, -1], padded[-1, 0], padded[-1, -1] = corners
+        self.halo = padded
+
+    def cups_around(self, idx, clean_only=False):
+        '''Return for the given visitors the number of cups on the floor in the surrounding cells, from the halo'''
+
+        x = self.x[idx] - self.x0 + 1
+        y = self.y[idx] - self.y0 + 1
+        return sum(self.halo[x + dx, y + dy] for dx, dy in NEIGHBOR_OFFSETS)
+
+    def take(self, leaving):
+        '''Remove the visitors in the mask from the tile and return their records'''
+
+        records = {name: getattr(self, name)[leaving] for name in VISITOR_FIELDS}
+        for name in VISITOR_FIELDS:
+            setattr(self, name, getattr(self, name)[~leaving])
+        return records
+
+    def add(self, records):
+        '''Add visitors that crossed into the tile'''
+
+        for name in VISITOR_FIELDS:
+            setattr(self, name, np.concatenate([getattr(self, name), records[name]]))
+
+    def remove_floor_cup(self, x, y):
+        '''Remove a collectable cup from the floor of a cell of the tile, return whether there was one'''
+
+        n = self.n_floor
+        options = np.flatnonzero((self.floor_x[:n] == x) & (self.floor_y[:n] == y) & (self.floor_dirt[:n] < 7))
+        if options.size == 0:
+            return False
+
+        cup, last = options[-1], n - 1
+        self.floor_x[cup] = self.floor_x[last]
+        self.floor_y[cup] = self.floor_y[last]
+        self.floor_dirt[cup] = self.floor_dirt[last]
+        self.n_floor = last
+        self.model.cups_on_floor -= 1
+        return True
+
+    def collect_cup(self, idx):
+        '''
+        If trash is around, possibly collect a cup. Cups in the tile are picked up directly, cups in the
+        halo are returned as requests for the tile that owns them.
+        '''
+
+        requests = []
+        if idx.size == 0:
+            return requests
+
+        possible = idx[self.cups_around(idx, clean_only=True) > 0]
+        success = possible[self.rng.random(possible.size) < self.model.awareness]
+
+        for v in self.rng.permutation(success):
+            x, y = self.x[v] - self.x0 + 1, self.y[v] - self.y0 + 1
+            options = [(dx, dy) for dx, dy in NEIGHBOR_OFFSETS if self.halo[x + dx, y + dy] > 0]
+            if not options:
+                continue
+
+            dx, dy = options[-1]
+            self.halo[x + dx, y + dy] -= 1
+            self.collected[v] += 1
+            cell = ((self.x[v] + dx) % self.width, (self.y[v] + dy) % self.height)
+            if self.x0 <= cell[0] < self.x1 and self.y0 <= cell[1] < self.y1:
+                self.remove_floor_cup(*cell)
+            else:
+                requests.append(cell)
+        return requests
+
+    def stats(self):
+        '''Return the cup counters of the tile'''
+
+        model = self.model
+        return model.cups_on_floor, model.cup_count, model.reuse_count, model.cups_returned, self.x.size
+
+
+def tile_worker(conn, spec):
+    '''
+    Run a single tile in its own process. Every step the coordinator takes the worker through the phases
+    move, drop, collect and resolve; see ShardedFestival.step.
+    '''
+
+    tile = TileVisitors(spec)
+    conn.send(tile.edges())
+    while True:
+        command, message = conn.recv()
+        if command == 'move':
+            tile.soil_cups()
+            tile.move()
+            leaving = (tile.x < tile.x0) | (tile.x >= tile.x1) | (tile.y < tile.y0) | (tile.y >= tile.y1)
+            conn.send(tile.take(leaving))
+        elif command == 'drop':
+            arriving, halo = message
+            for records in arriving:
+                tile.add(records)
+            tile.set_halo(halo)
+            droppers, collectors = tile.empty_cups()
+            tile.drop_cup(droppers)
+            tile.collectors = collectors
+            conn.send(tile.edges(clean_only=True))
+        elif command == 'collect':
+            tile.set_halo(message, clean_only=True)
+            conn.send(tile.collect_cup(tile.collectors))
+        elif command == 'resolve':
+            for x, y in message:
+                tile.remove_floor_cup(x, y)
+            tile.get_thirstier()
+            conn.send((tile.edges(), tile.stats()))
+        elif command == 'close':
+            conn.close()
+            return
+
+
+class ShardedFestival:
+    '''
+    A festival split into rectangular tiles, each simulated by its own worker process with the logic of
+    the vectorized engine. Visitors move to the worker of another tile when they cross its border, the
+    counts of floor cups along the borders are exchanged as a halo for drop_cup and collect_cup, and cups
+    collected across a border are picked up by the tile that owns them. Every worker knows all stands,
+    so find_stand works across tiles. The cup counters are summed over the workers every step.
+
+    Use as a context manager, or call close() to stop the workers.
+    '''
+
+    def __init__(self, drinks_for_cup=1, reluctance_avg=0.5, awareness=0.05, stands=((2, 5), (8, 7), (12, 12)), visitors=200, width=15, height=15, tiles=(2, 2), name='Base case', seed=None):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.num_visitors = visitors
+        self.drinks_for_cup = drinks_for_cup
+        self.steps = 0
+        self.model_vars = {"Lost cups": [], "Total cups": [], "Reuse count": []}
+
+        self.xs = np.linspace(0, width, tiles[0] + 1).astype(int)
+        self.ys = np.linspace(0, height, tiles[1] + 1).astype(int)
+        assert (np.diff(self.xs) > 0).all() and (np.diff(self.ys) > 0).all(), "more tiles than cells"
+        self.tiles = tiles
+
+        # spread the visitors over the tiles in proportion to their area
+        seeds = np.random.SeedSequence(seed)
+        rng = np.random.default_rng(seeds)
+        area = np.outer(np.diff(self.xs), np.diff(self.ys)).ravel()
+        counts = rng.multinomial(visitors, area / area.sum())
+
+        self.connections = []
+        self.workers = []
+        for t, tile_seed in enumerate(seeds.spawn(tiles[0] * tiles[1])):
+            i, j = divmod(t, tiles[1])
+            spec = {'width': width, 'height': height, 'xs': (self.xs[i], self.xs[i + 1]), 'ys': (self.ys[j], self.ys[j + 1]),
+                    'stands': stands, 'drinks_for_cup': drinks_for_cup, 'awareness': awareness,
+                    'reluctance_avg': reluctance_avg, 'visitors': counts[t], 'seed': tile_seed}
+            parent, child = Pipe()
+            worker = Process(target=tile_worker, args=(child, spec), daemon=True)
+            worker.start()
+            self.connections.append(parent)
+            self.workers.append(worker)
+
+        self.floor_edges = self.receive()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''Stop the workers'''
+
+        for conn in self.connections:
+            conn.send(('close', None))
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+
+    def send(self, command, messages):
+        for conn, message in zip(self.connections, messages):
+            conn.send((command, message))
+
+    def receive(self):
+        return [conn.recv() for conn in self.connections]
+
+    def owner(self, x, y):
+        '''Return the tile number owning every given cell'''
+
+        i = np.searchsorted(self.xs, x, side='right') - 1
+        j = np.searchsorted(self.ys, y, side='right') - 1
+        return i * self.tiles[1] + j
+
+    def halos(self, edges):
+        '''Build for every tile the halo of counts around it from the outer rows and columns of its neighbors'''
+
+        nx, ny = self.tiles
+        halos = []
+        for t in range(nx * ny):
+            i, j = divmod(t, ny)
+            tile = lambda di, dj: edges[((i + di) % nx) * ny + (j + dj) % ny]
+            corners = (tile(-1, -1)[1][-1], tile(-1, 1)[1][0], tile(1, -1)[0][-1], tile(1, 1)[0][0])
+            halos.append((tile(-1, 0)[1], tile(1, 0)[0], tile(0, -1)[3], tile(0, 1)[2], corners))
+        return halos
+
+    def step(self):
+        '''Advance all tiles by one step and reduce the cup counters'''
+
+        n = len(self.connections)
+
+        # move, and hand visitors that crossed a border to the tile they are in now
+        self.send('move', [None] * n)
+        arriving = [[] for t in range(n)]
+        for records in self.receive():
+            owners = self.owner(records['x'], records['y'])
+            for t in np.unique(owners):
+                arriving[t].append({name: values[owners == t] for name, values in records.items()})
+
+        # drop cups, with the floor counts of the neighbors from the end of the previous step
+        self.send('drop', zip(arriving, self.halos(self.floor_edges)))
+        clean_edges = self.receive()
+
+        # collect cups, pick-ups across a border are resolved by the owner of the cell
+        self.send('collect', self.halos(clean_edges))
+        requests = [[] for t in range(n)]
+        for cells in self.receive():
+            for x, y in cells:
+                requests[self.owner(x, y)].append((x, y))
+        self.send('resolve', requests)
+        results = self.receive()
+
+        self.floor_edges = [edges for edges, stats in results]
+        totals = np.sum([stats for edges, stats in results], axis=0)
+        self.cups_on_floor, self.cup_count, self.reuse_count, self.cups_returned, visitors = totals
+        assert visitors == self.num_visitors, "visitors lost between tiles"
+
+        self.steps += 1
+        self.model_vars["Lost cups"].append(self.cups_on_floor)
+        self.model_vars["Total cups"].append(self.cup_count)
+        self.model_vars["Reuse count"].append(self.reuse_count)
+
+    def get_model_vars_dataframe(self):
+        '''Return the collected cup counters, with the same columns as the DataCollector of Festival'''
+
+        import pandas as pd
+
+        return pd.DataFrame(self.model_vars)
@@ -0,0 +1,115 @@
+import numpy as np
+from mesa.space import MultiGrid
+
+
+class FestivalGrid(MultiGrid):
+    '''
+    MultiGrid that keeps per cell counts of the cups on the floor, so that Visitors can assess the trash
+    around them without scanning the agents in the surrounding cells. Cups should be put on and taken
+    off the floor through drop_cup and pick_up_cup, and soil_cup should be called when a cup on the
+    floor gets too dirty to be collected.
+
+    Also keeps a table of the Moore neighborhood of every cell, which get_neighborhood returns directly,
+    and counts drops, pickups and moves per cell in the CellAccumulators of the model, if it has them.
+    '''
+
+    def __init__(self, width, height, torus):
+        '''
+        Creates a new grid
+
+        Args:
+            width, height: the width and height of the grid
+            torus: whether the grid wraps around the edges
+        '''
+
+        super().__init__(width, height, torus)
+
+        # cups on the floor, and cups on the floor that are clean enough to be collected (dirty < 0.7)
+        self.floor_cups = np.zeros((width, height), dtype=np.int64)
+        self.clean_cups = np.zeros((width, height), dtype=np.int64)
+
+        # the same counts summed over the surrounding cells of every cell
+        self.floor_nearby = np.zeros((width, height), dtype=np.int64)
+        self.clean_nearby = np.zeros((width, height), dtype=np.int64)
+
+        self.hotspots = None # CellAccumulators, set by the model
+
+        self.build_neighborhoods()
+
+    def build_neighborhoods(self):
+        '''Build the Moore neighborhoods (without and with center) per cell, in the same order as MultiGrid returns them'''
+
+        self.moore = [[[super(FestivalGrid, self).get_neighborhood((x, y), True, center) for y in range(self.height)]
+                       for x in range(self.width)] for center in (False, True)]
+        self.moore_x = [[np.array([p[0] for p in cells]) for cells in column] for column in self.moore[0]]
+        self.moore_y = [[np.array([p[1] for p in cells]) for cells in column] for column in self.moore[0]]
+
+    def __getstate__(self):
+        '''Leave the neighborhood tables out of pickles, they are rebuilt when loaded'''
+
+        state = self.__dict__.copy()
+        for name in ('moore', 'moore_x', 'moore_y'):
+            del state[name]
+        state['_neighborhood_cache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.build_neighborhoods()
+
+    def get_neighborhood(self, pos, moore, include_center=False, radius=1):
+        '''Return the cells in the neighborhood of pos, from the table for the Moore neighborhood'''
+
+        if moore and radius == 1:
+            x, y = pos
+            return self.moore[include_center][x][y]
+        return super().get_neighborhood(pos, moore, include_center, radius)
+
+    def move_agent(self, agent, pos):
+        '''Move an agent to a cell, counting the move as traffic'''
+
+        super().move_agent(agent, pos)
+        if self.hotspots is not None:
+            self.hotspots.traffic[agent.pos] += 1
+
+    def count(self, counts, nearby, pos, n):
+        '''Add n cups to the counts of a cell and to the nearby counts of the surrounding cells'''
+
+        x, y = pos
+        counts[x, y] += n
+        nearby[self.moore_x[x][y], self.moore_y[x][y]] += n
+
+    def drop_cup(self, cup, pos):
+        '''Place a Cup on the floor'''
+
+        self.place_agent(cup, pos)
+        self.count(self.floor_cups, self.floor_nearby, pos, 1)
+        if cup.dirty < 0.7:
+            self.count(self.clean_cups, self.clean_nearby, pos, 1)
+        if self.hotspots is not None:
+            self.hotspots.drops[pos] += 1
+
+    def pick_up_cup(self, cup):
+        '''Remove a Cup from the floor'''
+
+        self.count(self.floor_cups, self.floor_nearby, cup.pos, -1)
+        if cup.dirty < 0.7:
+            self.count(self.clean_cups, self.clean_nearby, cup.pos, -1)
+        if self.hotspots is not None:
+            self.hotspots.pickups[cup.pos] += 1
+        self.remove_agent(cup)
+
+    def soil_cup(self, cup):
+        '''Register that a Cup on the floor has become too dirty to be collected'''
+
+        self.count(self.clean_cups, self.clean_nearby, cup.pos, -1)
+
+    def trash_around(self, pos):
+        '''Return the number of cups on the floor in the cells surrounding pos'''
+
+        return self.floor_nearby[pos]
+
+    def clean_around(self, pos):
+        '''Return the number of collectable cups on the floor in the cells surrounding pos'''
+
+        return self.clean_nearby[pos]
@@ -0,0 +1,148 @@
+import json
+import os
+import shutil
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+
+class PartitionWriter:
+    '''
+    Appends the model variables of a single (scenario, iteration) run to its partition, one raw binary
+    file per column. Rows are buffered and written in chunks; the partition only counts as complete once
+    the writer is closed. What was run, e.g. the parameters, seed and number of steps, can be recorded in
+    meta.json along with the columns.
+    '''
+
+    def __init__(self, path, columns, chunk=256, dtype='<i8', run=None):
+        self.path = path
+        self.columns = list(columns)
+        self.chunk = chunk
+        self.dtype = dtype
+        self.run = run or {}
+        self.rows = []
+        self.steps = 0
+
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ('meta.json', *(self.filename(c, t) for c in self.columns for t in ('<i8', '<f8'))):
+            (path / name).unlink(missing_ok=True) # start over an incomplete partition
+
+    @staticmethod
+    def filename(column, dtype='<i8'):
+        '''Return the file name of a column, with the type of its values as suffix: .i8 or .f8'''
+
+        return quote(column, safe='') + '.' + np.dtype(dtype).str[1:]
+
+    def append(self, row):
+        '''Append the values of one step, in the order of the columns'''
+
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        '''Write the buffered rows to the column files'''
+
+        if not self.rows:
+            return
+        values = np.array(self.rows, dtype=self.dtype).reshape(len(self.rows), len(self.columns))
+        for i, column in enumerate(self.columns):
+            with open(self.path / self.filename(column, self.dtype), 'ab') as f:
+                f.write(values[:, i].tobytes())
+        self.steps += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        '''Write the remaining rows and mark the partition as complete'''
+
+        self.flush()
+        with open(self.path / 'meta.json.tmp', 'w') as f:
+            json.dump({**self.run, 'columns': self.columns, 'dtype': self.dtype, 'steps': self.steps}, f)
+        os.replace(self.path / 'meta.json.tmp', self.path / 'meta.json')
+
+
+class ResultStore:
+    '''
+    Append-only columnar store of the model variables of batch runs on disk, partitioned by scenario and
+    iteration: <root>/<scenario>/<iteration>/<column>.i8. Columns are int64, or float64 (<column>.f8) for
+    runs recorded with window aggregates, as noted in meta.json. Columns are read as memory maps, so analysis only touches
+    the columns and steps it needs.
+    '''
+
+    def __init__(self, root='results'):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def partition(self, scenario, iteration):
+        return self.root / quote(scenario, safe='') / str(iteration)
+
+    def writer(self, scenario, iteration, columns, chunk=256, dtype='<i8', run=None):
+        '''Return a PartitionWriter for a run, run is a dict of what was run that is kept in meta.json'''
+
+        return PartitionWriter(self.partition(scenario, iteration), columns, chunk, dtype, run)
+
+    def meta(self, scenario, iteration):
+        '''Return the metadata of a complete partition, or None'''
+
+        try:
+            with open(self.partition(scenario, iteration) / 'meta.json') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def complete(self, scenario, iteration, run=None):
+        '''Return whether a run is complete, and if run is given, whether it was made with those values'''
+
+        meta = self.meta(scenario, iteration)
+        return meta is not None and all(meta.get(key) == value for key, value in (run or {}).items())
+
+    def scenarios(self):
+        '''Return the names of the scenarios in the store'''
+
+        return sorted(unquote(p.name) for p in self.root.iterdir() if p.is_dir())
+
+    def iterations(self, scenario):
+        '''Return the complete iterations of a scenario'''
+
+        path = self.root / quote(scenario, safe='')
+        found = sorted(int(p.name) for p in path.iterdir() if p.name.isdigit()) if path.exists() else []
+        return [i for i in found if self.complete(scenario, i)]
+
+    def column(self, scenario, iteration, column):
+        '''Return a column of a run as a read-only memory map'''
+
+        meta = self.meta(scenario, iteration)
+        if meta is None:
+            raise KeyError("run " + repr((scenario, iteration)) + " is not complete")
+        path = self.partition(scenario, iteration) / PartitionWriter.filename(column, meta['dtype'])
+        if not path.exists(): # written before the suffix followed the type
+            path = path.with_name(PartitionWriter.filename(column))
+        return np.memmap(path, dtype=meta['dtype'], mode='r', shape=(meta['steps'],))
+
+    def at_step(self, scenario, column, step):
+        '''Return the value of a column at one step for every iteration of a scenario'''
+
+        return np.array([self.column(scenario, i, column)[step] for i in self.iterations(scenario)])
+
+    def frame(self, scenario, columns=None):
+        '''Load the runs of a scenario as a DataFrame, in the format of run_scenarios'''
+
+        import pandas as pd
+
+        frames = []
+        for i in self.iterations(scenario):
+            names = columns or self.meta(scenario, i)['columns']
+            data = pd.DataFrame({c: np.asarray(self.column(scenario, i, c)) for c in names})
+            if 'Step' in data: # downsampled runs keep the step of every row
+                data = data.set_index(data.pop('Step').astype(np.int64))
+            data.index.name = 'Step'
+            data['Iteration'] = i
+            frames.append(data)
+        return pd.concat(frames)
+
+    def remove(self, scenario=None):
+        '''Remove a scenario, or everything, from the store'''
+
+        shutil.rmtree(self.root / quote(scenario, safe='') if scenario is not None else self.root)
+        self.root.mkdir(parents=True, exist_ok=True)
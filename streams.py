@@ -0,0 +1,50 @@
+import random
+from statistics import NormalDist
+
+import numpy as np
+
+
+# the random streams of a Festival: initial visitor attributes and positions, activation order, movement,
+# drop and collect decisions, and the dirt of cups on the floor
+STREAMS = ('init', 'order', 'move', 'decide', 'dirt')
+
+
+class InversionRandom(random.Random):
+    '''
+    random.Random that draws normal variates by inversion of a single uniform, instead of by rejection, so
+    that they follow the uniforms of the stream: mirrored uniforms give mirrored normal variates.
+    '''
+
+    def normalvariate(self, mu=0.0, sigma=1.0):
+        u = self.random()
+        while u == 0.0: # the inverse is not defined at 0
+            u = self.random()
+        return NormalDist(mu, sigma).inv_cdf(u)
+
+    gauss = normalvariate
+
+
+class AntitheticRandom(InversionRandom):
+    '''
+    Generator that makes the antithetic draws of InversionRandom with the same seed: 1 - u for every uniform u,
+    n - 1 - k for every integer k below n, so choice picks the mirrored element of a sequence, and -z for every
+    standard normal z. getrandbits is not mirrored, so neither is anything seeded from it.
+    '''
+
+    def random(self):
+        u = super().random()
+        return 1.0 - u if u > 0.0 else 0.0 # stay in [0, 1)
+
+    def _randbelow(self, n):
+        return n - 1 - super()._randbelow(n)
+
+
+def substreams(seed, antithetic=False):
+    '''
+    Return a dict of stream name -> independent generator, all derived from one seed, so a run draws the
+    same numbers for a purpose whatever happens in the other streams
+    '''
+
+    kind = AntitheticRandom if antithetic else InversionRandom
+    children = np.random.SeedSequence(seed).spawn(len(STREAMS))
+    return {name: kind(int.from_bytes(child.generate_state(4).tobytes(), 'little')) for name, child in zip(STREAMS, children)}
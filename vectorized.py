@@ -0,0 +1,289 @@
+import numpy as np
+from events import DROP, COLLECT, RETURN, BUY
+
+
+# Moore neighborhood without the center cell, as used by neighbor_iter in drop_cup and collect_cup
+NEIGHBOR_OFFSETS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if (dx, dy) != (0, 0)]
+
+
+class VisitorArrays:
+    '''
+    The Visitor population of a Festival stored as structure-of-arrays. Runs the same step logic as
+    Visitor.step (get_drink, reduce_thirst, random_move, move_towards, drop_cup, collect_cup) as
+    batched array operations on all visitors at once.
+
+    Visitors decide simultaneously on the state at the start of the step, instead of one after the other
+    in random order. Only collecting follows a random activation order as in the agent engine: a visitor
+    can only pick up the cups dropped in the same step by visitors before it, and conflicts (several
+    visitors picking up the same cup) are resolved in that order. Visitors buying the last returned cup of
+    a stand are served in random order.
+
+    The engines do not give the same Lost cups, neither per seed nor exactly in distribution. Over seeds 0 to
+    1999 of 200 steps of the default Festival, the vectorized engine lost 0.07 +- 0.46 cups more (of 30.4)
+    and used 2.6 +- 1.8 fewer cups in total (of 416). When all collectors saw every cup dropped in the
+    step, it lost 4% fewer cups. equivalence.py checks the differences against stated margins.
+    '''
+
+    def __init__(self, model):
+        '''
+        Creates the visitor population of the model
+
+        Args:
+            model: Festival with its stands already placed
+        '''
+
+        self.model = model
+        self.rng = np.random.default_rng(model.rng_init.getrandbits(64)) # a single stream, also with common random numbers, not mirrored when antithetic
+        self.width = model.grid.width
+        self.height = model.grid.height
+        n = model.num_visitors
+
+        # initial attributes, drawn from the same distributions as in Festival.__init__
+        self.reluctance = np.round(np.maximum(self.rng.normal(model.reluctance_avg, 0.5, n), 0), 1)
+        self.thirst_rate = np.maximum(self.rng.normal(10, 1, n), 0).astype(np.int64)
+        self.sip_size = np.maximum(self.rng.normal(30, 10, n), 0).astype(np.int64)
+        self.x = self.rng.integers(0, self.width, n)
+        self.y = self.rng.integers(0, self.height, n)
+
+        self.thirst = np.full(n, 20, dtype=np.int64) # initial thirst is 20%
+        self.fill = np.full(n, -1, dtype=np.int64) # ml left in the cup of each visitor, -1 if no cup
+        self.buying = np.zeros(n, dtype=bool)
+        self.collected = np.zeros(n, dtype=np.int64) # number of cups collected from the floor
+
+        self.stand_cups = np.zeros(len(model.stands), dtype=np.int64) # returned cups in inventory per stand
+        self.stands = list(model.stands) # the Stands of stand_cups, in order
+
+        # cups on the floor, dirt is counted in tenths
+        self.floor_x = np.zeros(64, dtype=np.int64)
+        self.floor_y = np.zeros(64, dtype=np.int64)
+        self.floor_dirt = np.zeros(64, dtype=np.int64)
+        self.floor_turn = np.zeros(64, dtype=np.int64) # turn of the visitor that dropped the cup this step, -1 for earlier steps
+        self.n_floor = 0
+
+        self.hotspots = model.hotspots # CellAccumulators or None
+
+    def conditions(self):
+        '''Return the condition of every visitor as used by visualize_model: 1 without cup, 2 with cup'''
+
+        return np.where(self.fill >= 0, 2, 1)
+
+    def cups_around(self, idx, clean_only=False):
+        '''Return for the given visitors the number of cups on the floor in the surrounding cells'''
+
+        return self.nearby(clean_only)[self.x[idx], self.y[idx]]
+
+    def counts(self, clean_only=False):
+        '''Return the number of cups on the floor per cell'''
+
+        n = self.n_floor
+        keep = self.floor_dirt[:n] < 7 if clean_only else slice(None)
+        cells = self.floor_x[:n][keep] * self.height + self.floor_y[:n][keep]
+        return np.bincount(cells, minlength=self.width * self.height).reshape(self.width, self.height)
+
+    def nearby(self, clean_only=False):
+        '''Return per cell the number of cups on the floor in the surrounding cells'''
+
+        counts = self.counts(clean_only)
+        total = np.zeros_like(counts)
+        for dx, dy in NEIGHBOR_OFFSETS:
+            total += np.roll(counts, (-dx, -dy), axis=(0, 1))
+        return total
+
+    def nearest_stand(self, x, y):
+        '''Return the index of the nearest stand for every given position, from the index of the model'''
+
+        if self.model.stand_index is None:
+            self.model.build_stand_index()
+            # stands were placed or removed, every remaining stand keeps its own inventory
+            inventory = dict(zip(self.stands, self.stand_cups))
+            self.stands = list(self.model.stands)
+            self.stand_cups = np.array([inventory.get(stand, 0) for stand in self.stands], dtype=np.int64)
+        return self.model.stand_index[x, y]
+
+    def soil_cups(self):
+        '''Cups on the floor get dirtier, same odds as Cup.step'''
+
+        n = self.n_floor
+        soiled = (self.rng.random(n) < 0.2) & (self.floor_dirt[:n] < 10)
+        self.floor_dirt[:n][soiled] += 1
+
+    def random_move(self, idx):
+        '''Step one cell in any direction of the Moore neighborhood, or stay'''
+
+        self.x[idx] = (self.x[idx] + self.rng.integers(-1, 2, idx.size)) % self.width
+        self.y[idx] = (self.y[idx] + self.rng.integers(-1, 2, idx.size)) % self.height
+        if self.hotspots is not None:
+            self.hotspots.add('traffic', self.x[idx], self.y[idx])
+
+    def move_towards(self, idx, goal):
+        '''Move one cell towards the given stands, along the shortest way around the torus'''
+
+        for pos, stand, size in ((self.x, self.model.stand_pos[:, 0], self.width),
+                                 (self.y, self.model.stand_pos[:, 1], self.height)):
+            distance = (stand[goal] - pos[idx]) % size
+            step = np.where(distance <= size / 2, 1, -1) * (distance != 0)
+            pos[idx] = (pos[idx] + step) % size
+        if self.hotspots is not None:
+            self.hotspots.add('traffic', self.x[idx], self.y[idx])
+
+    def buy_drink(self, idx, goal):
+        '''
+        Buy drinks for the given visitors at the given stands. Returning visitors get their own cup back,
+        the others reuse cups from the stand inventory in random order or get a new cup.
+        '''
+
+        model = self.model
+        log = model.log
+        self.buying[idx] = False
+
+        returning = self.fill[idx] >= 0
+        if log.active[RETURN]:
+            log.record_many(RETURN, model.schedule.time, idx[returning], self.x[idx[returning]], self.y[idx[returning]])
+        if log.active[BUY]:
+            log.record_many(BUY, model.schedule.time, idx, self.x[idx], self.y[idx])
+        n_returned = int(returning.sum())
+        model.cups_returned += n_returned
+        model.reuse_count += n_returned
+
+        # rank the visitors without cup per stand in random order
+        goal = goal[~returning]
+        order = self.rng.permutation(goal.size)
+        goal = goal[order]
+        goal = goal[np.argsort(goal, kind='stable')]
+        rank = np.arange(goal.size) - np.searchsorted(goal, goal)
+        reuse = rank < self.stand_cups[goal]
+
+        self.stand_cups -= np.bincount(goal[reuse], minlength=self.stand_cups.size)
+        model.reuse_count += int(reuse.sum())
+        new = int((~reuse).sum())
+        model.cup_count += new
+        model.cup_id += new
+
+        self.fill[idx] = 200
+
+    def drop_cup(self, idx, order=None):
+        '''Look at surrounding trash and possibly drop cup on the ground. order is the turn of every visitor in this step, if any.'''
+
+        self.floor_turn[:self.n_floor] = -1 # dropped in earlier steps
+        if idx.size == 0:
+            return
+
+        trash = self.cups_around(idx)
+        odds = np.minimum(0.1 + trash / 5, 1)
+        idx = idx[self.rng.random(idx.size) < odds]
+
+        # grow the floor arrays if needed
+        needed = self.n_floor + idx.size
+        if needed > self.floor_x.size:
+            size = max(needed, 2 * self.floor_x.size)
+            for name in ('floor_x', 'floor_y', 'floor_dirt', 'floor_turn'):
+                old = getattr(self, name)
+                new = np.zeros(size, dtype=old.dtype)
+                new[:old.size] = old
+                setattr(self, name, new)
+
+        new = slice(self.n_floor, needed)
+        self.floor_x[new] = self.x[idx]
+        self.floor_y[new] = self.y[idx]
+        self.floor_dirt[new] = 0
+        self.floor_turn[new] = order[idx] if order is not None else -1
+        self.n_floor = needed
+        self.fill[idx] = -1
+        self.model.cups_on_floor += idx.size
+        if self.hotspots is not None:
+            self.hotspots.add('drops', self.x[idx], self.y[idx])
+        if self.model.log.active[DROP]:
+            self.model.log.record_many(DROP, self.model.schedule.time, idx, self.x[idx], self.y[idx])
+
+    def collect_cup(self, idx, order=None):
+        '''
+        If trash is around, possibly collect a cup. Odds are based on the model attribute awareness. With the
+        turn of every visitor in this step as order, visitors collect in turn and only see the cups dropped
+        before their turn, otherwise they collect in random order and see every cup.
+        '''
+
+        if idx.size == 0:
+            return
+
+        possible = idx[self.cups_around(idx, clean_only=True) > 0]
+        success = possible[self.rng.random(possible.size) < self.model.awareness]
+
+        # pick up one by one, a cup can only be collected once
+        for v in (success[np.argsort(order[success])] if order is not None else self.rng.permutation(success)):
+            n = self.n_floor
+            dx = (self.floor_x[:n] - self.x[v] + 1) % self.width
+            dy = (self.floor_y[:n] - self.y[v] + 1) % self.height
+            around = (dx <= 2) & (dy <= 2) & ~((dx == 1) & (dy == 1))
+            if order is not None:
+                around &= self.floor_turn[:n] < order[v]
+            options = np.flatnonzero(around & (self.floor_dirt[:n] < 7))
+            if options.size == 0:
+                continue
+
+            # swap the last floor cup into the slot of the collected cup
+            cup, last = options[-1], n - 1
+            if self.model.log.active[COLLECT]:
+                self.model.log.record(COLLECT, self.model.schedule.time, v, (self.floor_x[cup], self.floor_y[cup]))
+            if self.hotspots is not None:
+                self.hotspots.pickups[self.floor_x[cup], self.floor_y[cup]] += 1
+            self.floor_x[cup] = self.floor_x[last]
+            self.floor_y[cup] = self.floor_y[last]
+            self.floor_dirt[cup] = self.floor_dirt[last]
+            self.floor_turn[cup] = self.floor_turn[last]
+            self.n_floor = last
+
+            self.collected[v] += 1
+            self.model.cups_on_floor -= 1
+
+    def move(self):
+        '''Drink, walk towards a stand or around, and buy drinks, with the same branching as Visitor.step and Visitor.get_drink'''
+
+        has_cup = self.fill >= 0
+        thirsty = self.thirst > 50
+        sip = ~self.buying & thirsty & has_cup & (self.fill > 0)
+        seek = self.buying | (thirsty & ~sip)
+        wander = ~seek & ~sip
+        early = seek & (self.thirst < 80) # not thirsty enough to get a drink
+        wander |= early
+        seek &= ~early
+        self.buying |= seek
+
+        # reduce thirst
+        self.fill[sip] -= np.minimum(self.fill[sip], self.sip_size[sip])
+        self.thirst[sip] -= np.minimum(self.thirst[sip], 20)
+        self.random_move(np.flatnonzero(wander | sip))
+
+        # get drink
+        idx = np.flatnonzero(seek)
+        goal = self.nearest_stand(self.x[idx], self.y[idx])
+        stand_pos = self.model.stand_pos[goal]
+        at_stand = (self.x[idx] == stand_pos[:, 0]) & (self.y[idx] == stand_pos[:, 1])
+        self.buy_drink(idx[at_stand], goal[at_stand])
+        self.move_towards(idx[~at_stand], goal[~at_stand])
+
+    def empty_cups(self):
+        '''Return the visitors with an empty cup that will try to drop it, and those that will look for cups to collect'''
+
+        empty = np.flatnonzero(self.fill == 0)
+        drops = self.reluctance[empty] > self.model.drinks_for_cup
+        return empty[drops], empty[~drops]
+
+    def get_thirstier(self):
+        '''At the end of every step visitors get more thirsty'''
+
+        self.thirst += np.minimum(self.thirst_rate, 100 - self.thirst)
+
+    def step(self):
+        '''Advance all visitors and the cups on the floor by one step'''
+
+        self.soil_cups()
+        self.move()
+
+        # decide what to do with an empty cup, collectors only see the cups dropped before their turn
+        droppers, collectors = self.empty_cups()
+        order = np.empty(self.fill.size, dtype=np.int64) # turns of the visitors with an empty cup, the others have none
+        order[np.concatenate([droppers, collectors])] = self.rng.permutation(droppers.size + collectors.size)
+        self.drop_cup(droppers, order)
+        self.collect_cup(collectors, order)
+
+        self.get_thirstier()
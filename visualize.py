@@ -4,22 +4,45 @@ import pandas as pd
 import seaborn as sns
 from matplotlib.colors import LinearSegmentedColormap
 from agents import Cup
-from model import get_cup, get_cup_on_floor, get_reuse_count
+from store import ResultStore
 
 def visualize_batch(df, length):
-    '''Visualize the data from the batchrunner'''
+    '''Visualize the data from the batchrunner, either a DataFrame or a ResultStore'''
 
     # first only retreive end values to get % lost cups per used cup
     fr = length - 1
     to = length
 
-    print(df.index.unique())
+    if isinstance(df, ResultStore):
+        store = df
+        scenarios = store.scenarios()
+    else:
+        scenarios = df.index.unique()
+
+    print(scenarios)
     result_list = []
-    for k in df.index.unique():
+    for k in scenarios:
         result = []
-        lost_cups = df.loc[k, 'Lost cups'][fr:to].values[0]
-        total_cups = df.loc[k, 'Total cups'][fr:to].values[0]
-        reused_cups = df.loc[k, 'Reuse count'][fr:to].values[0]
+        if isinstance(df, ResultStore):
+            # read only the last step of the first iteration from disk
+            first = store.iterations(k)[0]
+            row = fr
+            if 'Step' in store.meta(k, first)['columns']: # downsampled, the last row recorded up to that step
+                row = np.searchsorted(store.column(k, first, 'Step'), fr, side='right') - 1
+            lost_cups = store.column(k, first, 'Lost cups')[row]
+            total_cups = store.column(k, first, 'Total cups')[row]
+            reused_cups = store.column(k, first, 'Reuse count')[row]
+        elif 'Step' in df and 'Iteration' in df:
+            # the first iteration at the last step, or the last row recorded up to it for downsampled runs
+            rows = df.loc[[k]]
+            rows = rows[(rows['Iteration'] == rows['Iteration'].iloc[0]) & (rows['Step'] <= fr)]
+            lost_cups = rows['Lost cups'].values[-1]
+            total_cups = rows['Total cups'].values[-1]
+            reused_cups = rows['Reuse count'].values[-1]
+        else:
+            lost_cups = df.loc[k, 'Lost cups'][fr:to].values[0]
+            total_cups = df.loc[k, 'Total cups'][fr:to].values[0]
+            reused_cups = df.loc[k, 'Reuse count'][fr:to].values[0]
         perc_lost_cups = lost_cups / (total_cups + reused_cups)
         value = round(perc_lost_cups, 2) * 100
 
@@ -36,6 +59,58 @@ def visualize_batch(df, length):
 
     plt.show()
 
+def visualize_aggregates(aggregates, confidence=0.95):
+    '''Visualize the running statistics from run_aggregated: % lost per cup used at the end of the run (left) and over time (right)'''
+
+    result_list = []
+    for name, aggregate in aggregates.items():
+        stats = aggregate.stats['Lost ratio']
+        low, high = stats.interval(confidence)
+        result_list.append([name, stats.mean[-1] * 100, low[-1] * 100, high[-1] * 100, aggregate.iterations])
+
+    result_df = pd.DataFrame.from_records(result_list, columns=['name', 'percentage lost', 'low', 'high', 'iterations'])
+    print(str(result_df))
+
+    sns.set(style="whitegrid")
+    fig, ax = plt.subplots(1, 2, figsize=(15, 5), tight_layout=True)
+    ax[0].bar(result_df['name'], result_df['percentage lost'],
+              yerr=[result_df['percentage lost'] - result_df['low'], result_df['high'] - result_df['percentage lost']], capsize=4)
+    ax[0].set_ylabel("percentage lost")
+
+    for name, aggregate in aggregates.items():
+        stats = aggregate.stats['Lost ratio']
+        low, high = stats.interval(confidence)
+        line = ax[1].plot(aggregate.index, stats.mean * 100, label=name)[0]
+        ax[1].fill_between(aggregate.index, low * 100, high * 100, color=line.get_color(), alpha=0.2)
+    ax[1].set_xlabel("Steps")
+    ax[1].set_ylabel("percentage lost")
+    ax[1].legend()
+
+    plt.show()
+
+def visualize_hotspots(hotspots, save=True, show=False):
+    '''
+    Visualize the per cell counts of CellAccumulators, or a dict of scenario name -> CellAccumulators from
+    run_hotspots, as heatmaps per run: a row per scenario, a column per count, drawn like the grid of visualize_model
+    '''
+
+    from hotspots import FIELDS
+
+    if not isinstance(hotspots, dict):
+        hotspots = {"": hotspots}
+    titles = {'drops': "cups dropped", 'pickups': "cups collected", 'dwell': "cup-steps on the floor", 'traffic': "visitor moves"}
+
+    fig, ax = plt.subplots(len(hotspots), len(FIELDS), figsize=(4 * len(FIELDS), 3.5 * len(hotspots)), squeeze=False, tight_layout=True)
+    for row, (name, counts) in enumerate(hotspots.items()):
+        for column, field in enumerate(FIELDS):
+            sns.heatmap(counts.mean(field), ax=ax[row, column], cmap='rocket_r', square=True, cbar=True)
+            ax[row, column].set_title((name + ": " if name else "") + titles[field] + " per run (" + str(counts.runs) + " runs)", fontsize=9)
+
+    if save:
+        plt.savefig("hotspots_van_PlasticProject_ABM.png", dpi=100, bbox_inches='tight')
+    if show:
+        plt.show()
+
 def visualize_model(model, save=True, show=False):
     '''
     Visualize the model in a grid (left) and a line graph (right)
@@ -49,7 +124,7 @@ def visualize_model(model, save=True, show=False):
     }
 
     # percentage verloren cups berekenen
-    lost_per_use = round(get_cup_on_floor(model) / (get_cup(model) + get_reuse_count(model)), 2) * 100
+    lost_per_use = round(model.cups_on_floor / (model.cup_count + model.reuse_count), 2) * 100
 
     #set up the lay-out for the grid and the graph
     fig, ax = plt.subplots(1, 2, figsize=(10, 5), facecolor=(1, 1, 1), tight_layout=True)
@@ -68,6 +143,9 @@ def visualize_model(model, save=True, show=False):
     """""Make the grid for later display"""""
     grid = np.zeros((model.grid.height, model.grid.width)) #Make a grid filled with zero's
 
+    if model.engine == "vectorized":
+        grid[model.visitors.x, model.visitors.y] = model.visitors.conditions()
+
     #Iterate trough all the agents and chance the value of their cell to their corresponding value
     for agent in model.schedule.agents:
             if not isinstance(agent, Cup):
@@ -0,0 +1,326 @@
+import hashlib
+import json
+import os
+import pickle
+import socket
+import sqlite3
+import sys
+import time
+import traceback
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+from batch import job_seed
+from cache import params_digest
+from model import Festival
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    scenario TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    params BLOB NOT NULL,
+    steps INTEGER NOT NULL,
+    seed INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (scenario, iteration)
+);
+CREATE TABLE IF NOT EXISTS results (
+    scenario TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    worker TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (scenario, iteration)
+);
+'''
+
+
+def job_digest(params, steps, seed):
+    '''Return a hash of what a job runs: the Festival parameters of its scenario, its number of steps and its seed'''
+
+    return hashlib.sha256(json.dumps([params_digest(params), steps, seed]).encode()).hexdigest()
+
+
+def worker_name():
+    '''Return a name for this worker process that is unique over hosts'''
+
+    return socket.gethostname() + ':' + str(os.getpid())
+
+
+class WorkQueue:
+    '''
+    Batch jobs and their results in a SQLite database, so any number of workers, on this host or on others
+    that share the file, can take part in a batch and a batch survives crashes of the workers and of the
+    process that started it.
+
+    A worker claims a job with a lease and renews it while running. A job whose lease ran out, because its
+    worker stalled or died, is handed out again, as is a job that failed, until it has been attempted
+    max_attempts times. Results are stored once per (scenario, iteration): a late result of a job that was
+    handed out again is ignored, so every job counts exactly once.
+
+    Every job carries a digest of its parameters, steps and seed. A job that is enqueued again with another
+    digest, e.g. with other steps, is reset and its old result dropped, so results never mix batches. Jobs
+    that are not done and not part of the batch that was enqueued last are stale and are not handed out.
+    '''
+
+    def __init__(self, path='queue.db', lease=60, max_attempts=3):
+        '''
+        Opens or creates a queue
+
+        Args:
+            path: the SQLite database file
+            lease: seconds a claimed job stays with its worker without a heartbeat
+            max_attempts: attempts of a job before it is given up as failed
+        '''
+
+        self.path = str(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+            if 'digest' not in [column[1] for column in db.execute('PRAGMA table_info(jobs)')]:
+                raise ValueError(self.path + " is a queue of an older version, remove it to start over")
+
+    @contextmanager
+    def connect(self):
+        # autocommit, transactions are begun explicitly so claims are atomic over processes
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def enqueue(self, parameters_list, iterations, max_steps, seed=0, common_random_numbers=False):
+        '''
+        Add a job per scenario and iteration, with the seeds of run_scenarios. Jobs that are already in the
+        queue with the same parameters, steps and seed are left as they are, so enqueueing a batch again resumes
+        it. Jobs with other parameters, steps or seed are reset and their results dropped. Jobs of earlier batches
+        that are not done, e.g. iterations beyond those of this batch, become stale, so workers do not run them.
+        Returns the number of jobs added or reset.
+        '''
+
+        names = [params['name'] for params in parameters_list]
+        assert len(set(names)) == len(names), "scenario names must be unique"
+
+        jobs = []
+        for position, params in enumerate(parameters_list):
+            for iteration in range(iterations):
+                run_seed = job_seed(seed, params, iteration, common_random_numbers)
+                jobs.append((params['name'], iteration, position, pickle.dumps(params), max_steps, run_seed, job_digest(params, max_steps, run_seed)))
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            before = db.total_changes
+            db.executemany("INSERT INTO jobs (scenario, iteration, position, params, steps, seed, digest) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                           "ON CONFLICT (scenario, iteration) DO UPDATE SET position = excluded.position, params = excluded.params, "
+                           "steps = excluded.steps, seed = excluded.seed, digest = excluded.digest, state = 'pending', worker = NULL, "
+                           "lease_until = NULL, attempts = 0, error = NULL WHERE jobs.digest != excluded.digest OR jobs.state = 'stale'", jobs)
+            changed = db.total_changes - before
+            # jobs of earlier batches that are not done
+            db.execute('CREATE TEMP TABLE batch (scenario TEXT NOT NULL, iteration INTEGER NOT NULL, PRIMARY KEY (scenario, iteration))')
+            db.executemany('INSERT INTO batch VALUES (?, ?)', [job[:2] for job in jobs])
+            db.execute("UPDATE jobs SET state = 'stale', worker = NULL, lease_until = NULL WHERE state IN ('pending', 'running', 'failed') "
+                       "AND NOT EXISTS (SELECT 1 FROM batch b WHERE b.scenario = jobs.scenario AND b.iteration = jobs.iteration)")
+            # results of jobs that were reset
+            db.execute('DELETE FROM results WHERE NOT EXISTS (SELECT 1 FROM jobs j WHERE j.scenario = results.scenario '
+                       'AND j.iteration = results.iteration AND j.digest = results.digest)')
+            db.execute('COMMIT')
+        return changed
+
+    def claim(self, worker):
+        '''Claim the next job for a worker, returns (scenario, iteration, params, steps, seed, digest) or None if there is none'''
+
+        now = time.time()
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            # stalled jobs that have no attempts left
+            db.execute("UPDATE jobs SET state = 'failed', error = 'lease expired' WHERE state = 'running' AND lease_until < ? AND attempts >= ?",
+                       (now, self.max_attempts))
+            row = db.execute("SELECT scenario, iteration, params, steps, seed, digest FROM jobs "
+                             "WHERE state = 'pending' OR (state = 'running' AND lease_until < ?) "
+                             "ORDER BY attempts, position, iteration LIMIT 1", (now,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE scenario = ? AND iteration = ?",
+                           (worker, now + self.lease, row[0], row[1]))
+            db.execute('COMMIT')
+        if row is None:
+            return None
+        scenario, iteration, params, steps, seed, digest = row
+        return scenario, iteration, pickle.loads(params), steps, seed, digest
+
+    def heartbeat(self, worker, scenario, iteration):
+        '''Renew the lease of a running job, returns False if the worker no longer holds it'''
+
+        with self.connect() as db:
+            renewed = db.execute("UPDATE jobs SET lease_until = ? WHERE scenario = ? AND iteration = ? AND worker = ? AND state = 'running'",
+                                 (time.time() + self.lease, scenario, iteration, worker)).rowcount
+        return renewed > 0
+
+    def complete(self, worker, scenario, iteration, digest, data):
+        '''Store the result of a job, unless a result of the job was already stored or the job was reset since it was claimed'''
+
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('INSERT OR IGNORE INTO results (scenario, iteration, worker, digest, data) SELECT scenario, iteration, ?, digest, ? FROM jobs '
+                       'WHERE scenario = ? AND iteration = ? AND digest = ?', (worker, blob, scenario, iteration, digest))
+            db.execute("UPDATE jobs SET state = 'done', lease_until = NULL, error = NULL WHERE scenario = ? AND iteration = ? AND digest = ?",
+                       (scenario, iteration, digest))
+            db.execute('COMMIT')
+
+    def fail(self, worker, scenario, iteration, error):
+        '''Give a job back after an error, it is retried until it has no attempts left'''
+
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, lease_until = NULL, error = ? "
+                       "WHERE scenario = ? AND iteration = ? AND worker = ? AND state = 'running'",
+                       (self.max_attempts, error, scenario, iteration, worker))
+
+    def retry_failed(self):
+        '''Give the failed jobs new attempts, returns their number'''
+
+        with self.connect() as db:
+            return db.execute("UPDATE jobs SET state = 'pending', attempts = 0 WHERE state = 'failed'").rowcount
+
+    def counts(self):
+        '''Return a dict of job state -> number of jobs'''
+
+        with self.connect() as db:
+            return dict(db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def finished(self):
+        '''Return whether every job is done or failed'''
+
+        counts = self.counts()
+        return counts.get('pending', 0) + counts.get('running', 0) == 0
+
+    def errors(self):
+        '''Return (scenario, iteration, attempts, error) of the jobs that failed'''
+
+        with self.connect() as db:
+            return db.execute("SELECT scenario, iteration, attempts, error FROM jobs WHERE state = 'failed' ORDER BY position, iteration").fetchall()
+
+    def results(self, names=None, iterations=None):
+        '''
+        Return the collected results like run_scenarios: a dict of scenario name -> DataFrame with the model
+        variables of its finished iterations, in order of iteration. Optionally only of the given scenarios
+        and of their first iterations, e.g. of the batch that was enqueued last.
+        '''
+
+        import pandas as pd
+
+        with self.connect() as db:
+            rows = db.execute('SELECT j.scenario, j.iteration, r.data FROM jobs j JOIN results r '
+                              'ON j.scenario = r.scenario AND j.iteration = r.iteration AND j.digest = r.digest '
+                              'ORDER BY j.position, j.iteration').fetchall()
+        results = {}
+        for scenario, iteration, blob in rows:
+            if (names is not None and scenario not in names) or (iterations is not None and iteration >= iterations):
+                continue
+            results.setdefault(scenario, []).append(pickle.loads(blob))
+        return {scenario: pd.concat(frames) for scenario, frames in results.items()}
+
+
+def run_claimed(queue, worker, job, heartbeat):
+    '''Run a claimed job, renewing its lease every heartbeat seconds. Returns its model variables, or None if the lease was lost.'''
+
+    scenario, iteration, params, max_steps, seed, digest = job
+    model = Festival(seed=seed, **params)
+    beat = time.monotonic()
+    for i in range(max_steps):
+        model.step()
+        if time.monotonic() - beat > heartbeat:
+            if not queue.heartbeat(worker, scenario, iteration):
+                model.datacollector.close()
+                return None # handed out again, the other worker stores the result
+            beat = time.monotonic()
+    model.datacollector.finish() # downsampled runs end with the last step
+
+    data = model.datacollector.get_model_vars_dataframe()
+    model.datacollector.close() # delete the spill file, if any
+    data.index.name = 'Step'
+    data['Iteration'] = iteration
+    return data
+
+
+def work(path, lease=60, max_attempts=3, heartbeat=None, max_jobs=None, wait=0):
+    '''
+    Run jobs of a queue until there are none left, or max_jobs are done. With wait, keep polling for new or
+    expired jobs every wait seconds until every job is done or failed. Returns the number of jobs done.
+    '''
+
+    queue = WorkQueue(path, lease, max_attempts)
+    worker = worker_name()
+    heartbeat = heartbeat if heartbeat is not None else lease / 3
+    done = 0
+    while max_jobs is None or done < max_jobs:
+        job = queue.claim(worker)
+        if job is None:
+            if not wait or queue.finished():
+                break
+            time.sleep(wait)
+            continue
+        scenario, iteration, digest = job[0], job[1], job[-1]
+        try:
+            data = run_claimed(queue, worker, job, heartbeat)
+        except Exception:
+            queue.fail(worker, scenario, iteration, traceback.format_exc())
+            continue
+        if data is not None:
+            queue.complete(worker, scenario, iteration, digest, data)
+            done += 1
+    return done
+
+
+def run_queued(parameters_list, iterations, max_steps, path='queue.db', processes=None, seed=0, display_progress=True, lease=60, max_attempts=3):
+    '''
+    Run every scenario a number of iterations like run_scenarios, through a WorkQueue. Starts processes
+    local workers, workers on other hosts can join with: python workqueue.py work PATH. Runs that finished
+    before a crash are kept in the queue, so running the same batch again only runs what is left. Runs of a
+    scenario whose parameters, steps or seed changed are run again.
+
+    Returns:
+        dict of scenario name -> DataFrame with the model variables of all finished iterations, in order of iteration
+    '''
+
+    queue = WorkQueue(path, lease, max_attempts)
+    queue.enqueue(parameters_list, iterations, max_steps, seed)
+
+    counts = queue.counts()
+    total = sum(counts.values()) - counts.get('stale', 0)
+    processes = processes or os.cpu_count()
+    with Pool(processes) as pool:
+        workers = [pool.apply_async(work, (path, lease, max_attempts, None, None, 1)) for i in range(processes)]
+        with tqdm(total=total, disable=not display_progress) as progress:
+            while not all(w.ready() for w in workers):
+                time.sleep(0.5)
+                counts = queue.counts()
+                progress.update(counts.get('done', 0) + counts.get('failed', 0) - progress.n)
+        for w in workers:
+            w.get() # raise errors of the workers themselves
+
+    for scenario, iteration, attempts, error in queue.errors():
+        print("failed:", scenario, "iteration", iteration, "after", attempts, "attempts\n" + (error or ""), file=sys.stderr)
+    return queue.results([params['name'] for params in parameters_list], iterations)
+
+
+# Run jobs on any host with: python workqueue.py work queue.db
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    path = sys.argv[2] if len(sys.argv) > 2 else 'queue.db'
+    if command == 'work':
+        print(work(path, wait=5), "jobs done by", worker_name())
+    elif command == 'status':
+        print(WorkQueue(path).counts())
+    elif command == 'retry':
+        print(WorkQueue(path).retry_failed(), "failed jobs queued again")
+    else:
+        sys.exit("usage: python workqueue.py [status|work|retry] [path]")